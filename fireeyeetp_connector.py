@@ -14,15 +14,32 @@
 # and limitations under the License.
 #
 
+import email.policy
+import fcntl
+import functools
 import hashlib
+import heapq
+import ipaddress
+import itertools
 import json
 import os
+import queue
+import random
 import re
+import shutil
 import sys
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.parser import BytesFeedParser
+from email.utils import getaddresses, parsedate_to_datetime
 from urllib.parse import quote, unquote
 
+import encryption_helper
 import phantom.app as phantom
 import pytz
 import requests
@@ -30,6 +47,7 @@ from bs4 import BeautifulSoup
 from phantom import vault
 from phantom.action_result import ActionResult
 from phantom.base_connector import BaseConnector
+from requests.adapters import HTTPAdapter
 
 # Usage of the consts file is recommended
 from fireeyeetp_consts import *
@@ -40,6 +58,179 @@ class RetVal(tuple):
         return tuple.__new__(RetVal, (val1, val2))
 
 
+@functools.cache
+def is_fips_enabled():
+    """Check if FIPS mode is enabled on the platform, once per process"""
+    try:
+        from phantom_common.install_info import is_fips_enabled as platform_fips_enabled
+    except ImportError:
+        return False
+
+    return bool(platform_fips_enabled())
+
+
+def fingerprint(*parts):
+    """Hash values into a stable identifier, with blake2b or with sha256 when FIPS mode is enabled"""
+    data = "\x1f".join("" if part is None else str(part) for part in parts).encode("utf-8")
+    if is_fips_enabled():
+        return hashlib.sha256(data).hexdigest()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class StreamingEmailParser:
+    """Incremental parser of a raw email fed chunk by chunk while it is downloaded.
+    Only the first max_size bytes are parsed, the rest of the email is ignored.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: Maximum number of bytes parsed
+        """
+        self._parser = BytesFeedParser(policy=email.policy.default)
+        self._max_size = max_size
+        self._size = 0
+        self.truncated = False
+
+    def feed(self, chunk):
+        """Parse the next chunk of the email"""
+        if self.truncated:
+            return
+        if self._size + len(chunk) > self._max_size:
+            chunk = chunk[: self._max_size - self._size]
+            self.truncated = True
+        self._size += len(chunk)
+        self._parser.feed(chunk)
+
+    def close(self):
+        """Finish parsing and return the parsed email message"""
+        return self._parser.close()
+
+
+class SharedTokenBucket:
+    """Token bucket shared by every connector process of an asset so that concurrent runs stay under the API quota together.
+    The bucket lives in a file next to the asset state file and every update happens under an exclusive file lock.
+    Waiters are served in arrival order, so a burst of runs cannot starve the others (e.g. on_poll).
+    """
+
+    def __init__(self, path, rate, capacity):
+        """
+        :param path: Path of the file holding the bucket
+        :param rate: Number of tokens added per second
+        :param capacity: Maximum number of tokens the bucket can hold (burst size)
+        """
+        self._path = path
+        self._lock_path = f"{path}.lock"
+        self._rate = rate
+        self._capacity = capacity
+
+    def _update(self, func):
+        """Run func on the bucket state while holding the file lock and persist the result.
+        A separate file object is opened on each call so that the lock also serializes the threads of one process.
+        """
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self._path) as f:
+                        bucket = json.load(f)
+                    if not isinstance(bucket, dict):
+                        raise ValueError("Unexpected rate limit file format")
+                except Exception:
+                    bucket = {"tokens": self._capacity, "last": time.time(), "queue": []}
+
+                result = func(bucket)
+
+                tmp_path = f"{self._path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(bucket, f)
+                os.replace(tmp_path, self._path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        return result
+
+    def acquire(self):
+        """Block until this caller is first in the queue and a token is available, then consume it"""
+        ticket = uuid.uuid4().hex
+
+        def take(bucket):
+            now = time.time()
+            bucket["tokens"] = min(self._capacity, bucket.get("tokens", 0) + max(0, now - bucket.get("last", now)) * self._rate)
+            bucket["last"] = now
+
+            # Drop the waiters that stopped refreshing their entry, e.g. a run that was killed
+            queue = [entry for entry in bucket.get("queue", []) if now - entry[1] < FIREEYEETP_RATE_LIMIT_QUEUE_TTL]
+            tickets = [entry[0] for entry in queue]
+            if ticket in tickets:
+                position = tickets.index(ticket)
+                queue[position][1] = now
+            else:
+                position = len(queue)
+                queue.append([ticket, now])
+            bucket["queue"] = queue
+
+            if position == 0 and bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                queue.pop(0)
+                return 0
+
+            return max(FIREEYEETP_RATE_LIMIT_MIN_WAIT, (position + 1 - bucket["tokens"]) / self._rate)
+
+        while True:
+            wait = self._update(take)
+            if not wait:
+                return
+            # Wake up regularly to keep the queue entry alive
+            time.sleep(min(wait, FIREEYEETP_RATE_LIMIT_MAX_WAIT))
+
+
+class ContainerIndex:
+    """Bounded map of a key (e.g. an alert ID) to the ID of the container created for it.
+    The least recently used keys are evicted first. The map is kept in a file next to the asset state file.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        :param path: Path of the file holding the index
+        :param max_size: Maximum number of keys kept in the index
+        """
+        self._path = path
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    def load(self):
+        """Load the index from its file, an unreadable file gives an empty index"""
+        try:
+            with open(self._path) as f:
+                entries = json.load(f)
+            self._entries = OrderedDict((str(key), value) for key, value in entries)
+        except Exception:
+            self._entries = OrderedDict()
+
+    def save(self):
+        """Persist the index to its file"""
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp_path, self._path)
+
+    def get(self, key):
+        """Get the container ID of a key, marking the key as recently used"""
+        key = str(key)
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def add(self, key, container_id):
+        """Add or refresh a key, evicting the least recently used keys beyond the maximum size"""
+        key = str(key)
+        self._entries[key] = container_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
 class FireeyeEtpConnector(BaseConnector):
     def __init__(self):
         # Call the BaseConnectors init first
@@ -52,6 +243,17 @@ class FireeyeEtpConnector(BaseConnector):
         # modify this as you deem fit.
         self._base_url = None
         self._verify_server_cert = True
+        self._session = None
+        self._header = None
+        self._use_oauth = False
+        self._rate_limiter = None
+        self._max_retries = FIREEYEETP_DEFAULT_MAX_RETRIES
+        self._max_retry_time = FIREEYEETP_DEFAULT_MAX_RETRY_TIME
+        self._retry_time_spent = 0
+        self._max_download_size = 0
+        self._debug_body_limit = FIREEYEETP_DEFAULT_DEBUG_BODY_LIMIT
+        self._pool_maxsize = FIREEYEETP_DEFAULT_POOL_MAXSIZE
+        self._alert_detail_fields = []
 
     def _get_error_message_from_exception(self, e):
         """
@@ -157,7 +359,11 @@ class FireeyeEtpConnector(BaseConnector):
 
         return RetVal(action_result.set_status(phantom.APP_ERROR, message), None)
 
-    def _process_file_response(self, r, action_result):
+    def _process_file_response(self, r, action_result, download_path=None, chunk_handler=None):
+        # Stream the file straight to disk instead of loading it in memory
+        if download_path and 200 <= r.status_code < 399:
+            return self._stream_file_response(r, action_result, download_path, chunk_handler)
+
         # Try to parse the file data with the .content
         try:
             resp_json = r.content
@@ -174,17 +380,85 @@ class FireeyeEtpConnector(BaseConnector):
 
         return RetVal(action_result.set_status(phantom.APP_ERROR, message), None)
 
-    def _process_response(self, r, action_result):
-        # store the r_text in debug data, it will get dumped in the logs if the action fails
+    def _stream_file_response(self, r, action_result, download_path, chunk_handler=None):
+        """Write the response body to a file chunk by chunk, computing its SHA-256 on the way.
+        :param r: Streamed response
+        :param action_result: Action result object
+        :param download_path: Path of the file to write
+        :param chunk_handler: Optional function called with each chunk of the file
+        :return: status success/failure, dict with the size and SHA-256 of the file
+        """
+        size_err = f"The file exceeds the maximum download size of {self._max_download_size} bytes"
+        try:
+            if self._max_download_size and int(r.headers.get("Content-Length") or 0) > self._max_download_size:
+                r.close()
+                return RetVal(action_result.set_status(phantom.APP_ERROR, size_err), None)
+
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(download_path, "wb") as file_obj:
+                for chunk in r.iter_content(chunk_size=FIREEYEETP_DOWNLOAD_CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if self._max_download_size and size > self._max_download_size:
+                        r.close()
+                        return RetVal(action_result.set_status(phantom.APP_ERROR, size_err), None)
+                    sha256.update(chunk)
+                    file_obj.write(chunk)
+                    if chunk_handler:
+                        chunk_handler(chunk)
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            return RetVal(action_result.set_status(phantom.APP_ERROR, f"Error while downloading the file. {err}"), None)
+
+        return RetVal(phantom.APP_SUCCESS, {"size": size, "sha256": sha256.hexdigest()})
+
+    def _add_debug_body(self, r, action_result, download_path=None):
+        """Store a bounded copy of the response body in the debug data, it will get dumped in the logs if the action fails.
+        Binary and streamed bodies are skipped.
+        :param r: Response object
+        :param action_result: Action result object
+        :param download_path: Path the response was streamed to, if any
+        """
+        if not hasattr(action_result, "add_debug_data") or not self._debug_body_limit:
+            return
+
+        content_type = r.headers.get("Content-Type", "")
+        is_text = not content_type or any(text_type in content_type for text_type in FIREEYEETP_TEXT_CONTENT_TYPES)
+        # Files are still showing a Content-Type of JSON although there is no JSON data.
+        if download_path or r.headers.get("Content-Disposition") or not is_text:
+            action_result.add_debug_data({"r_text": f"Body of content type '{content_type}' omitted"})
+            return
+
+        try:
+            body = r.content
+            r_text = body[: self._debug_body_limit].decode(r.encoding or "utf-8", errors="replace")
+            if len(body) > self._debug_body_limit:
+                r_text = f"{r_text}... ({len(body)} bytes in total)"
+        except Exception as e:
+            r_text = f"Unable to read the body. {self._get_error_message_from_exception(e)}"
+
+        action_result.add_debug_data({"r_text": r_text})
+
+    def _process_response(self, r, action_result, download_path=None, chunk_handler=None):
+        # store the status and headers in debug data, the body is only added if the call fails
         if hasattr(action_result, "add_debug_data"):
             action_result.add_debug_data({"r_status_code": r.status_code})
-            action_result.add_debug_data({"r_text": r.text})
             action_result.add_debug_data({"r_headers": r.headers})
 
+        ret_val, response = self._process_response_content(r, action_result, download_path, chunk_handler)
+
+        if phantom.is_fail(ret_val):
+            self._add_debug_body(r, action_result, download_path)
+
+        return RetVal(ret_val, response)
+
+    def _process_response_content(self, r, action_result, download_path=None, chunk_handler=None):
         # Check to see if we are downloading a file.
         # Files are still showing a Content-Type of JSON although there is no JSON data.
         if r.headers.get("Content-Disposition"):
-            return self._process_file_response(r, action_result)
+            return self._process_file_response(r, action_result, download_path, chunk_handler)
 
         # Process each 'Content-Type' of response separately
 
@@ -210,13 +484,19 @@ class FireeyeEtpConnector(BaseConnector):
 
         return RetVal(action_result.set_status(phantom.APP_ERROR, message), None)
 
-    def _make_rest_call(self, endpoint, action_result, method="get", **kwargs):
+    def _make_rest_call(self, endpoint, action_result, method="get", download_path=None, chunk_handler=None, retry_server_errors=True, **kwargs):
         # **kwargs can be any additional parameters that requests.request accepts
+        # If download_path is given, a file response is streamed to that path instead of being returned,
+        # and chunk_handler, if given, is called with each chunk of the file
+        # Requests that change data on the server pass retry_server_errors=False, so they are not sent again after a 5xx
 
         resp_json = None
 
+        if download_path:
+            kwargs["stream"] = True
+
         try:
-            request_func = getattr(requests, method)
+            request_func = getattr(self._session, method)
         except AttributeError:
             return RetVal(action_result.set_status(phantom.APP_ERROR, f"Invalid method: {method}"), resp_json)
 
@@ -227,7 +507,14 @@ class FireeyeEtpConnector(BaseConnector):
             err = "Please provide valid asset configuration and|or the action parameters"
             return RetVal(action_result.set_status(phantom.APP_ERROR, err), resp_json)
         try:
-            r = request_func(url, verify=self._verify_server_cert, headers=self._header, **kwargs)
+            r = self._send_request(request_func, url, retry_server_errors, **kwargs)
+
+            # The cached OAuth token may have been revoked or expired early, refresh it once and retry
+            if r.status_code == 401 and self._use_oauth:
+                self.debug_print("Received status code 401, refreshing the OAuth token")
+                r.close()
+                self._header = self.authenticate(self.get_config(), force_refresh=True)
+                r = self._send_request(request_func, url, retry_server_errors, **kwargs)
         except requests.exceptions.InvalidSchema:
             err = f"Error connecting to server. No connection adapters were found for {url}"
             return RetVal(action_result.set_status(phantom.APP_ERROR, err), resp_json)
@@ -238,10 +525,117 @@ class FireeyeEtpConnector(BaseConnector):
             err = self._get_error_message_from_exception(e)
             return RetVal(action_result.set_status(phantom.APP_ERROR, f"Error Connecting to server. Details: {err}"), resp_json)
 
-        return self._process_response(r, action_result)
+        return self._process_response(r, action_result, download_path, chunk_handler)
+
+    def _send_request(self, request_func, url, retry_server_errors=True, **kwargs):
+        """Send the request, retrying throttled (429) and, if allowed, server error (5xx) responses.
+        The wait honors the 'Retry-After' header when present, otherwise a jittered exponential backoff is used.
+        The total time spent waiting for retries is capped for the whole run.
+        :param request_func: Session method to call
+        :param url: URL to call
+        :param retry_server_errors: Whether to retry server error (5xx) responses
+        :param **kwargs: Additional arguments for the request
+        :return: response
+        """
+        retry_status_codes = FIREEYEETP_RETRY_STATUS_CODES
+        if retry_server_errors:
+            retry_status_codes += FIREEYEETP_SERVER_ERROR_STATUS_CODES
+        retry_count = 0
 
-    def _save_file_to_vault(self, data, filename, container_id, action_result):
-        # Creating temporary directory and file
+        while True:
+            if self._rate_limiter:
+                self._rate_limiter.acquire()
+
+            r = request_func(url, verify=self._verify_server_cert, headers=self._header, **kwargs)
+
+            if r.status_code not in retry_status_codes or retry_count >= self._max_retries:
+                return r
+
+            wait = self._get_retry_wait(r, retry_count)
+            if self._retry_time_spent + wait > self._max_retry_time:
+                self.debug_print(f"Retry time budget exhausted, giving up on status code {r.status_code}")
+                return r
+
+            self.debug_print(f"Received status code {r.status_code}, retrying in {wait:.2f} seconds")
+            r.close()
+            time.sleep(wait)
+            self._retry_time_spent += wait
+            retry_count += 1
+
+    def _get_retry_wait(self, r, retry_count):
+        """Get the number of seconds to wait before retrying the request.
+        :param r: Response to retry
+        :param retry_count: Number of retries already done for the request
+        :return: number of seconds
+        """
+        retry_after = r.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except Exception:
+                self.debug_print(f"Unable to parse the 'Retry-After' header value: {retry_after}")
+
+        # Full jitter exponential backoff
+        return random.uniform(0, min(FIREEYEETP_MAX_BACKOFF, FIREEYEETP_BACKOFF_FACTOR * (2**retry_count)))
+
+    def _get_safe_filename(self, filename):
+        """Get the name a file is added to the vault with.
+        :param filename: Name of the file
+        :return: file name without path or unsafe characters
+        """
+        safe_filename = re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(str(filename)))
+        if not safe_filename or not safe_filename.strip("."):
+            safe_filename = "download.bin"
+        return safe_filename
+
+    def _find_vault_file(self, container_id=None, file_name=None, sha256=None, vault_id=None):
+        """Find a file in the vault by ID, name and/or content.
+        :param container_id: ID of the container to search, None for all the containers
+        :param file_name: Name of the file
+        :param sha256: SHA-256 of the content of the file
+        :param vault_id: Vault ID of the file
+        :return: vault info of the first matching file or None
+        """
+        try:
+            success, _, files = vault.vault_info(vault_id=vault_id, container_id=container_id, file_name=file_name)
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            self.debug_print(f"Unable to search the vault. {err}")
+            return None
+
+        if not success or not files:
+            return None
+
+        for info in files:
+            if sha256 and (info.get("metadata") or {}).get("sha256") != sha256:
+                continue
+            return info
+
+        return None
+
+    def _get_vault_details(self, info):
+        """Get the vault details of a file already in the vault, in the format returned by _download_file_to_vault.
+        :param info: vault info of the file
+        :return: vault details
+        """
+        return {
+            phantom.APP_JSON_VAULT_ID: info.get("vault_id"),
+            "file_name": info.get("name"),
+            "size": info.get("size"),
+            "sha256": (info.get("metadata") or {}).get("sha256"),
+            "deduplicated": True,
+        }
+
+    def _create_vault_tmp_file(self, filename, action_result):
+        """Create a temporary directory in the vault tmp directory and a safe path for the file inside it.
+        :param filename: Name of the file
+        :param action_result: Action result object
+        :return: status success/failure, dict with the temporary directory, file path and file name
+        """
         try:
             if hasattr(vault, "get_vault_tmp_dir"):
                 temp_dir = vault.get_vault_tmp_dir()
@@ -252,31 +646,35 @@ class FireeyeEtpConnector(BaseConnector):
 
             os.makedirs(temp_dir)
 
-            safe_filename = re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(str(filename)))
-            if not safe_filename or not safe_filename.strip("."):
-                safe_filename = "download.bin"
+            safe_filename = self._get_safe_filename(filename)
             file_path = os.path.realpath(os.path.join(temp_dir, safe_filename))
             if os.path.commonpath([os.path.realpath(temp_dir), file_path]) != os.path.realpath(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
                 return action_result.set_status(phantom.APP_ERROR, "Invalid download filename"), None
-
-            with open(file_path, "wb") as file_obj:
-                file_obj.write(data)
         except Exception as e:
             err = self._get_error_message_from_exception(e)
-            return action_result.set_status(phantom.APP_ERROR, "Error while writing to temporary file", err), None
+            return action_result.set_status(phantom.APP_ERROR, "Error while creating temporary file", err), None
+
+        return phantom.APP_SUCCESS, {"temp_dir": temp_dir, "file_path": file_path, "file_name": safe_filename}
 
-        # Adding pcap to vault
-        success, message, vault_id = vault.vault_add(container_id, file_path, safe_filename)
+    def _add_file_to_vault(self, tmp_file, container_id, action_result):
+        """Add a file created with _create_vault_tmp_file to the vault and remove its temporary directory.
+        :param tmp_file: dict returned by _create_vault_tmp_file
+        :param container_id: ID of the container to add the file to
+        :param action_result: Action result object
+        :return: status success/failure, vault details
+        """
+        success, message, vault_id = vault.vault_add(container_id, tmp_file["file_path"], tmp_file["file_name"])
 
         # Removing temporary directory created to download file
         try:
-            os.rmdir(temp_dir)
+            os.rmdir(tmp_file["temp_dir"])
         except Exception:
             return action_result.set_status(phantom.APP_ERROR, "Unable to remove temporary directory"), None
 
         # Updating data with vault details
         if success:
-            vault_details = {phantom.APP_JSON_VAULT_ID: vault_id, "file_name": safe_filename}
+            vault_details = {phantom.APP_JSON_VAULT_ID: vault_id, "file_name": tmp_file["file_name"]}
             return phantom.APP_SUCCESS, vault_details
 
         # Error while adding report to vault
@@ -286,88 +684,228 @@ class FireeyeEtpConnector(BaseConnector):
         # Set the action_result status to error, the handler function will most probably return as is
         return phantom.APP_ERROR, None
 
-    def _paginator(self, endpoint, action_result, data, method="get", **kwargs):
-        """This function is used to handle the gathering of alerts for the list alerts action.
-            Note: the parameters need to be valid Python Requests parameters
+    def _save_file_to_vault(self, data, filename, container_id, action_result):
+        # Creating temporary directory and file
+        ret_val, tmp_file = self._create_vault_tmp_file(filename, action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status(), None
 
-        :param endpoint: API endpoint to use to get the alerts
-        :param action results: Action results for Phantom
-        :param data: dict of parameters to send to the API endpoint
+        # A response without a file body fails here, as it is not bytes
+        try:
+            with open(tmp_file["file_path"], "wb") as file_obj:
+                file_obj.write(data)
+            sha256 = hashlib.sha256(data).hexdigest()
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            return action_result.set_status(phantom.APP_ERROR, "Error while writing to temporary file", err), None
+
+        # The same content already in the container is not stored again
+        existing = self._find_vault_file(container_id, sha256=sha256) if container_id else None
+        if existing:
+            shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            return phantom.APP_SUCCESS, self._get_vault_details(existing)
+
+        return self._add_file_to_vault(tmp_file, container_id, action_result)
+
+    def _copy_vault_file(self, info, container_id, action_result):
+        """Add a file already in the vault of another container to a container without downloading it again.
+        :param info: vault info of the file
+        :param container_id: ID of the container to add the file to
+        :param action_result: Action result object
+        :return: status success/failure, vault details
+        """
+        ret_val, tmp_file = self._create_vault_tmp_file(info.get("name"), action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status(), None
+
+        try:
+            shutil.copyfile(info["path"], tmp_file["file_path"])
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            return action_result.set_status(phantom.APP_ERROR, "Error while copying the vault file", err), None
+
+        ret_val, vault_details = self._add_file_to_vault(tmp_file, container_id, action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status(), None
+
+        vault_details.update({"size": info.get("size"), "sha256": (info.get("metadata") or {}).get("sha256"), "deduplicated": True})
+        return phantom.APP_SUCCESS, vault_details
+
+    def _download_file_to_vault(self, endpoint, filename, container_id, action_result, method="post", chunk_handler=None, **kwargs):
+        """Stream a file from the API into the vault without holding it in memory.
+        :param endpoint: API endpoint returning the file
+        :param filename: Name of the file in the vault
+        :param container_id: ID of the container to add the file to
+        :param action_result: Action result object
         :param method: HTTP method to use when calling the API endpoint
+        :param chunk_handler: Optional function called with each chunk of the file
         :param **kwargs: Optional and additional arguments to use for calling the API endpoint.
-        :return: a list of alerts
+        :return: status success/failure, vault details with the size and SHA-256 of the file
         """
-        items_list = list()
+        ret_val, tmp_file = self._create_vault_tmp_file(filename, action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status(), None
 
-        while True:
-            ret_val, items = self._make_rest_call(endpoint, action_result, json=data, method=method, **kwargs)
+        ret_val, file_info = self._make_rest_call(
+            endpoint, action_result, method=method, download_path=tmp_file["file_path"], chunk_handler=chunk_handler, **kwargs
+        )
 
-            if phantom.is_fail(ret_val):
-                return action_result.get_status(), None
-            else:
-                try:
-                    limit = items.get("meta", {}).get("total") - len(items_list)
-                except Exception:
-                    return action_result.set_status(phantom.APP_ERROR, "Unable to process response"), None
+        if phantom.is_success(ret_val) and not (isinstance(file_info, dict) and file_info.get("sha256")):
+            ret_val = action_result.set_status(phantom.APP_ERROR, "No file was returned by the server")
 
-            if items.get("data"):
-                for item in items.get("data"):
-                    items_list.append(item)
-            else:
-                break
+        if phantom.is_fail(ret_val):
+            shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            return action_result.get_status(), None
 
-            try:
-                if limit and items.get("meta", {}).get("total") >= limit:
-                    if endpoint == FIREETEETP_LIST_ALERTS_ENDPOINT:
-                        data["fromLastModifiedOn"] = items.get("meta", {}).get("fromLastModifiedOn", {}).get("end")
-                    elif endpoint == FIREEYEETP_LIST_QUARANTINED_EMAILS_ENDPOINT:
-                        data["attributes"]["date"]["to_date"] = items.get("meta", {}).get("timestamp_quarantine")
-            except Exception:
-                return action_result.set_status(phantom.APP_ERROR, "Unable to process response"), None
+        # The same content already in the container is not stored again
+        existing = self._find_vault_file(container_id, sha256=file_info["sha256"]) if container_id else None
+        if existing:
+            shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            return phantom.APP_SUCCESS, self._get_vault_details(existing)
 
-            if limit <= 0:
-                break
+        ret_val, vault_details = self._add_file_to_vault(tmp_file, container_id, action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status(), None
 
-        return phantom.APP_SUCCESS, items_list
+        vault_details.update(file_info)
+        vault_details["deduplicated"] = False
 
-    def _paginator2(self, endpoint, action_result, data, limit=None, method="get", **kwargs):
-        """This function is used to handle the gathering of alerts for the on_poll action.
-            Note: these parameters need to be valid Python Requests parameters
+        return phantom.APP_SUCCESS, vault_details
 
-        :param endpoint: API endpoint to use to get the alerts
-        :param action results: Action results for Phantom
-        :param data: dict of parameters to send to the API endpoint
-        :param limit: The number of alerts to ingest
+    def _paginate(self, endpoint, action_result, data, method="post", max_items=None, deadline=None, progress=None, **kwargs):
+        """This generator walks a paginated endpoint and yields one page of items at a time, so the items never need to be held all at once.
+        The cursor used to request the next page is declared per endpoint in FIREEYEETP_PAGINATION_CURSORS.
+        Items repeated across a page boundary are dropped.
+            Note: the parameters need to be valid Python Requests parameters
+
+        :param endpoint: API endpoint to get the items from
+        :param action_result: Action results for Phantom
+        :param data: dict of parameters to send to the API endpoint, the cursor is updated in place
         :param method: HTTP method to use when calling the API endpoint
+        :param max_items: Stop once this number of items has been yielded
+        :param deadline: time.monotonic() value after which no new page is requested
+        :param progress: Optional dict updated with the number of 'pages' and 'items' and the 'stop_reason'
         :param **kwargs: Optional and additional arguments to use for calling the API endpoint.
-        :return: a list of alerts
+        :return: generator of status and list of items
         """
+        cursor = FIREEYEETP_PAGINATION_CURSORS[endpoint]
+        progress = progress if progress is not None else {}
+        progress.update({"pages": 0, "items": 0, "stop_reason": None})
+        page_size = data.get("size")
+        previous_ids = set()
 
-        items_list = list()
-
-        while limit > 0:
-            ret_val, items = self._make_rest_call(endpoint, action_result, json=data, method=method, **kwargs)
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                progress["stop_reason"] = "deadline"
+                return
 
+            ret_val, response = self._make_rest_call(endpoint, action_result, json=data, method=method, **kwargs)
             if phantom.is_fail(ret_val):
-                return action_result.get_status(), None
-
-            if items.get("data"):
-                for item in items.get("data"):
-                    items_list.append(item)
-            else:
-                break
+                yield RetVal(action_result.get_status(), None)
+                return
 
             try:
-                if limit and items.get("meta", {}).get("total") >= limit:
-                    limit = limit - items.get("meta", {}).get("total")
-                    data["fromLastModifiedOn"] = items.get("meta", {}).get("fromLastModifiedOn", {}).get("end")
-
-                if items.get("meta", {}).get("total") < limit:
-                    break
+                items = response.get("data") or []
+                total = response.get("meta", {}).get("total")
+                next_cursor = response.get("meta", {})
+                for key in cursor["meta_path"]:
+                    next_cursor = next_cursor.get(key) if isinstance(next_cursor, dict) else None
+
+                target = data
+                for key in cursor["request_path"][:-1]:
+                    target = target.setdefault(key, {})
             except Exception:
-                return action_result.set_status(phantom.APP_ERROR, "Unable to access attributes of items response"), None
+                yield RetVal(action_result.set_status(phantom.APP_ERROR, "Unable to process response"), None)
+                return
+
+            page = []
+            page_ids = set()
+            for item in items:
+                item_id = item.get(cursor["id_field"]) if isinstance(item, dict) else None
+                if item_id is not None:
+                    if item_id in previous_ids or item_id in page_ids:
+                        continue
+                    page_ids.add(item_id)
+                page.append(item)
+
+            if max_items is not None:
+                page = page[: max_items - progress["items"]]
+
+            progress["pages"] += 1
+            progress["items"] += len(page)
+
+            if page:
+                yield RetVal(phantom.APP_SUCCESS, page)
+
+            if max_items is not None and progress["items"] >= max_items:
+                progress["stop_reason"] = "max_items"
+                return
+
+            # Stop on the last page, or when the cursor does not move forward anymore
+            current_cursor = target.get(cursor["request_path"][-1])
+            if (
+                not page
+                or (page_size and len(items) < page_size)
+                or (isinstance(total, int) and len(items) >= total)
+                or not next_cursor
+                or next_cursor == current_cursor
+            ):
+                progress["stop_reason"] = "exhausted"
+                return
+
+            target[cursor["request_path"][-1]] = next_cursor
+            previous_ids = page_ids
+
+    def _prefetch_pages(self, pages, depth, action_result):
+        """This generator fetches the next pages in a background thread while the caller processes the current one,
+        so that waiting on the API and saving to the platform overlap. At most depth pages are held ahead of the caller.
+        :param pages: Generator of status and list of items, e.g. returned by _paginate
+        :param depth: Number of pages fetched ahead, 0 to fetch in the calling thread
+        :param action_result: Action result object
+        :return: generator of status and list of items
+        """
+        if not depth:
+            yield from pages
+            return
+
+        page_queue = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    page_queue.put(item, timeout=FIREEYEETP_PREFETCH_WAIT)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for page in pages:
+                    if not put(page):
+                        return
+            except Exception as e:
+                err = self._get_error_message_from_exception(e)
+                put(RetVal(action_result.set_status(phantom.APP_ERROR, f"Error while fetching the alerts. {err}"), None))
+            finally:
+                put(done)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
 
-        return phantom.APP_SUCCESS, items_list
+        try:
+            while True:
+                item = page_queue.get()
+                if item is done:
+                    return
+                yield item
+        finally:
+            stop.set()
+            producer.join()
 
     def _handle_test_connectivity(self, param):
         action_result = self.add_action_result(ActionResult(dict(param)))
@@ -441,24 +979,158 @@ class FireeyeEtpConnector(BaseConnector):
         except Exception:
             return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'num_days' action parameter")
 
-        endpoint = FIREETEETP_LIST_ALERTS_ENDPOINT
-
-        # make rest call
-        ret_val, response = self._paginator(endpoint, action_result, data, method="post")
+        # Check the 'shards' parameter
+        ret_val, shards = self._validate_integer(action_result, param.get("shards", 1), SHARDS_KEY)
         if phantom.is_fail(ret_val):
             return action_result.get_status()
 
-        # Add the response into the data section
-        if isinstance(response, list):
-            for alert in response:
+        # Fetch the time range as concurrent time windows, each window costs a count probe so their number is capped
+        shards = min(shards, FIREEYEETP_SHARD_POOL_MULTIPLIER * self._pool_maxsize)
+        if shards > 1:
+            ret_val = self._list_alerts_sharded(action_result, data, num_days or FIREEYEETP_DEFAULT_NUM_DAYS, shards)
+            if phantom.is_fail(ret_val):
+                return action_result.get_status()
+            return action_result.set_status(phantom.APP_SUCCESS)
+
+        endpoint = FIREETEETP_LIST_ALERTS_ENDPOINT
+
+        # make rest call, adding each page of alerts into the data section as it arrives
+        for ret_val, alerts in self._paginate(endpoint, action_result, data, method="post"):
+            if phantom.is_fail(ret_val):
+                return action_result.get_status()
+
+            for alert in alerts:
                 action_result.add_data(alert)
-        else:
-            action_result.add_data(response)
 
         # Return success, no need to set the message, only the status
         # BaseConnector will create a textual message based off of the summary dictionary
         return action_result.set_status(phantom.APP_SUCCESS)
 
+    def _count_alerts(self, data, start, end):
+        """This function is used to get the number of alerts modified in a time window with a single-item request.
+        :param data: dict of parameters to send to the API endpoint
+        :param start: Start of the time window
+        :param end: End of the time window, None for no end
+        :return: status success/failure, number of alerts or error message
+        """
+        probe_data = dict(data)
+        probe_data["size"] = 1
+        probe_data["fromLastModifiedOn"] = start.strftime(FIREEYEETP_SHARD_TIME_FORMAT)
+        if end is None:
+            probe_data.pop("toLastModifiedOn", None)
+        else:
+            probe_data["toLastModifiedOn"] = end.strftime(FIREEYEETP_SHARD_TIME_FORMAT)
+
+        probe_result = ActionResult()
+        ret_val, response = self._make_rest_call(FIREETEETP_LIST_ALERTS_ENDPOINT, probe_result, json=probe_data, method="post")
+        if phantom.is_fail(ret_val):
+            return phantom.APP_ERROR, probe_result.get_message()
+
+        try:
+            return phantom.APP_SUCCESS, int(response.get("meta", {}).get("total") or 0)
+        except Exception:
+            return phantom.APP_ERROR, "Unable to get the number of alerts from the response"
+
+    def _fetch_alert_window(self, data, start, end):
+        """This function is used to fetch all the alerts modified in a time window.
+        :param data: dict of parameters to send to the API endpoint
+        :param start: Start of the time window
+        :param end: End of the time window
+        :return: status success/failure, list of alerts or error message
+        """
+        window_data = dict(data)
+        window_data["fromLastModifiedOn"] = start.strftime(FIREEYEETP_SHARD_TIME_FORMAT)
+        window_data["toLastModifiedOn"] = end.strftime(FIREEYEETP_SHARD_TIME_FORMAT)
+
+        window_result = ActionResult()
+        alerts = []
+        for ret_val, page in self._paginate(FIREETEETP_LIST_ALERTS_ENDPOINT, window_result, window_data, method="post"):
+            if phantom.is_fail(ret_val):
+                return phantom.APP_ERROR, window_result.get_message()
+            alerts.extend(page)
+
+        return phantom.APP_SUCCESS, alerts
+
+    def _list_alerts_sharded(self, action_result, data, num_days, shards):
+        """This function is used to fetch the alerts of the last num_days days as concurrent time windows.
+        The windows are sized with count probes, so that one busy window does not dominate the run time,
+        then fetched in parallel and added to the action result in time order without duplicates.
+        :param action_result: Action result object
+        :param data: dict of parameters to send to the API endpoint
+        :param num_days: Number of days to get the alerts for
+        :param shards: Number of time windows
+        :return: status success/failure
+        """
+        end = datetime.utcnow()
+        start = end - timedelta(days=num_days)
+        step = (end - start) / shards
+        windows = [[start + step * i, start + step * (i + 1)] for i in range(shards)]
+
+        with ThreadPoolExecutor(max_workers=min(shards, self._pool_maxsize)) as executor:
+
+            def count_windows(windows):
+                counts = []
+                for ret_val, count in executor.map(lambda window: self._count_alerts(data, *window), windows):
+                    if phantom.is_fail(ret_val):
+                        return action_result.set_status(phantom.APP_ERROR, f"Unable to count the alerts. {count}"), None
+                    counts.append(count)
+                return phantom.APP_SUCCESS, counts
+
+            ret_val, counts = count_windows(windows)
+            if phantom.is_fail(ret_val):
+                return action_result.get_status()
+
+            # Split the windows holding far more than their share of the alerts, then drop the empty ones.
+            # The total does not change when a window is split, so only the new halves are counted.
+            target = max(1, sum(counts) // shards)
+            for _ in range(FIREEYEETP_SHARD_SPLIT_ROUNDS):
+                splits = [
+                    count > 2 * target and window[1] - window[0] > timedelta(seconds=FIREEYEETP_SHARD_MIN_SECONDS)
+                    for window, count in zip(windows, counts)
+                ]
+                if not any(splits):
+                    break
+
+                halves = []
+                for window, split in zip(windows, splits):
+                    if split:
+                        middle = window[0] + (window[1] - window[0]) / 2
+                        halves.extend([[window[0], middle], [middle, window[1]]])
+
+                ret_val, half_counts = count_windows(halves)
+                if phantom.is_fail(ret_val):
+                    return action_result.get_status()
+
+                sized = []
+                split_halves = iter(zip(halves, half_counts))
+                for window, count, split in zip(windows, counts, splits):
+                    sized.extend([next(split_halves), next(split_halves)] if split else [(window, count)])
+                windows = [window for window, _ in sized]
+                counts = [count for _, count in sized]
+
+            windows = [window for window, count in zip(windows, counts) if count]
+            self.save_progress(f"Fetching the alerts in {len(windows)} time windows")
+
+            futures = [executor.submit(self._fetch_alert_window, data, *window) for window in windows]
+
+            # Windows overlap on their boundaries, drop the alerts already added
+            seen_ids = set()
+            for future in futures:
+                ret_val, alerts = future.result()
+                if phantom.is_fail(ret_val):
+                    for pending in futures:
+                        pending.cancel()
+                    return action_result.set_status(phantom.APP_ERROR, f"Unable to fetch the alerts. {alerts}")
+
+                for alert in alerts:
+                    alert_id = alert.get("id")
+                    if alert_id in seen_ids:
+                        continue
+                    seen_ids.add(alert_id)
+                    action_result.add_data(alert)
+
+        return phantom.APP_SUCCESS
+
     def _handle_get_alert(self, param):
         action_result = self.add_action_result(ActionResult(dict(param)))
 
@@ -480,6 +1152,69 @@ class FireeyeEtpConnector(BaseConnector):
         # BaseConnector will create a textual message based off of the summary dictionary
         return action_result.set_status(phantom.APP_SUCCESS)
 
+    def _get_alert_by_id(self, alert_id):
+        """This function is used to get the details of an alert, with its own action result so that it can run in a worker thread.
+        :param alert_id: ID of the alert
+        :return: status success/failure, response or error message
+        """
+        try:
+            endpoint = FIREETEETP_GET_ALERT_ENDPOINT.format(alertId=quote(str(alert_id), safe=""))
+        except Exception:
+            return phantom.APP_ERROR, "Invalid alert ID"
+
+        alert_result = ActionResult()
+        ret_val, response = self._make_rest_call(endpoint, alert_result)
+        if phantom.is_fail(ret_val):
+            return phantom.APP_ERROR, alert_result.get_message()
+
+        return phantom.APP_SUCCESS, response
+
+    def _handle_get_alerts(self, param):
+        action_result = self.add_action_result(ActionResult(dict(param)))
+
+        # Check the 'alert_ids' parameter
+        try:
+            alert_ids = [x.strip() for x in param.get("alert_ids", "").split(",")]
+            alert_ids = [_f for _f in alert_ids if _f]
+        except Exception:
+            alert_ids = []
+        if not alert_ids:
+            return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'alert_ids' action parameter")
+
+        # Check the 'max_workers' parameter
+        ret_val, max_workers = self._validate_integer(action_result, param.get("max_workers", FIREEYEETP_DEFAULT_MAX_WORKERS), MAX_WORKERS_KEY)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        # More workers than pooled connections would open connections that are not kept for reuse
+        unique_ids = list(OrderedDict.fromkeys(alert_ids))
+        max_workers = min(max_workers, self._pool_maxsize, len(unique_ids))
+        self.save_progress(f"Getting {len(unique_ids)} alerts with {max_workers} workers")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {alert_id: executor.submit(self._get_alert_by_id, alert_id) for alert_id in unique_ids}
+
+            # Add the results in the order of the IDs, a failed alert does not fail the others
+            failed = 0
+            for alert_id in alert_ids:
+                ret_val, response = futures[alert_id].result()
+                if phantom.is_fail(ret_val):
+                    failed += 1
+                    action_result.add_data({"alert_id": alert_id, "status": "failed", "message": response})
+                else:
+                    data = {"alert_id": alert_id, "status": "success"}
+                    data.update(response if isinstance(response, dict) else {"data": response})
+                    action_result.add_data(data)
+
+        action_result.update_summary({"total_alerts": len(alert_ids), "alerts_failed": failed})
+
+        if failed == len(alert_ids):
+            return action_result.set_status(phantom.APP_ERROR, "Unable to get any of the alerts")
+
+        # Return success, no need to set the message, only the status
+        # BaseConnector will create a textual message based off of the summary dictionary
+        return action_result.set_status(phantom.APP_SUCCESS)
+
     def _handle_list_email_attributes(self, param):
         # Add an action result object to self (BaseConnector) to represent the action for this param
         action_result = self.add_action_result(ActionResult(dict(param)))
@@ -678,6 +1413,10 @@ class FireeyeEtpConnector(BaseConnector):
 
         endpoint = FIREETEETP_GET_EMAIL_ENDPOINT.format(etp_message_id=quote(str(etp_message_id_param), safe=""))
 
+        # Parse the email while it is streamed to the vault, only the parsed summary is added to the data section
+        if param.get("parse_email", False):
+            return self._download_and_parse_email(endpoint, filename, action_result)
+
         # make rest call
         ret_val, response = self._make_rest_call(endpoint, action_result)
 
@@ -696,35 +1435,176 @@ class FireeyeEtpConnector(BaseConnector):
         # BaseConnector will create a textual message based off of the summary dictionary
         return action_result.set_status(phantom.APP_SUCCESS)
 
-    def _handle_download_pcap(self, param):
-        # Add an action result object to self (BaseConnector) to represent the action for this param
-        action_result = self.add_action_result(ActionResult(dict(param)))
-
-        alert_id_param = param["alert_id"]
+    def _download_and_parse_email(self, endpoint, filename, action_result):
+        """This function is used to stream a raw email into the vault, parsing it on the way,
+        and to add header, URL, attachment hash and sender IP artifacts to the container.
+        :param endpoint: API endpoint returning the raw email
+        :param filename: Name of the file in the vault
+        :param action_result: Action result object
+        :return: status success/failure
+        """
+        container_id = self.get_container_id()
+        parser = StreamingEmailParser(FIREEYEETP_EMAIL_MAX_PARSE_SIZE)
 
-        data = {}
+        ret_val, vault_details = self._download_file_to_vault(
+            endpoint, filename, container_id, action_result, method="get", chunk_handler=parser.feed
+        )
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
 
-        # Set the file name for the vault
         try:
-            filename = f"{alert_id_param}_pcap.zip"
-        except Exception:
-            return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'alert_id' action parameter")
+            message = parser.close()
+            summary, artifacts = self._parse_email_message(message, vault_details, container_id)
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            return action_result.set_status(phantom.APP_ERROR, f"Unable to parse the email. {err}")
 
-        endpoint = FIREETEETP_GET_ALERT_PCAP_FILES_ENDPOINT.format(alertId=quote(str(alert_id_param), safe=""))
+        summary["truncated"] = summary["truncated"] or parser.truncated
+        if artifacts:
+            ret_val, message, _ = self.save_artifacts(artifacts)
+            if phantom.is_fail(ret_val):
+                return action_result.set_status(phantom.APP_ERROR, f"Unable to save the artifacts of the email. {message}")
+        summary["artifacts"] = len(artifacts)
 
-        # make rest call
-        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data, stream=True)
+        action_result.add_data(summary)
+        action_result.update_summary({"attachments": len(summary["attachments"]), "urls": len(summary["urls"]), "artifacts": len(artifacts)})
 
-        if phantom.is_fail(ret_val):
-            return action_result.get_status()
+        return action_result.set_status(phantom.APP_SUCCESS)
 
-        ret_val, vault_details = self._save_file_to_vault(response, filename, self.get_container_id(), action_result)
+    def _parse_email_message(self, message, vault_details, container_id):
+        """This function is used to summarize a parsed email and create its artifacts.
+        Only the first FIREEYEETP_EMAIL_MAX_PARTS parts of the email are looked at.
+        :param message: Parsed email message
+        :param vault_details: Vault details of the raw email
+        :param container_id: ID of the container to add the artifacts to
+        :return: summary of the email, list of artifacts
+        """
+
+        def header(name):
+            try:
+                value = message.get(name)
+                return str(value) if value is not None else None
+            except Exception:
+                return None
+
+        email_sha256 = vault_details.get("sha256")
+        summary = dict(vault_details)
+        summary.update(
+            {
+                "from": header("From"),
+                "to": header("To"),
+                "cc": header("Cc"),
+                "subject": header("Subject"),
+                "date": header("Date"),
+                "message_id": header("Message-ID"),
+                "sender_ip": self._get_email_sender_ip(message),
+                "part_count": 0,
+                "attachments": [],
+                "urls": [],
+                "truncated": False,
+            }
+        )
+
+        urls = OrderedDict()
+        for part in message.walk():
+            if summary["part_count"] >= FIREEYEETP_EMAIL_MAX_PARTS:
+                summary["truncated"] = True
+                break
+            summary["part_count"] += 1
+
+            if part.is_multipart():
+                continue
+
+            file_name = part.get_filename()
+            content_type = part.get_content_type()
+            if file_name or part.get_content_disposition() == "attachment":
+                payload = part.get_payload(decode=True) or b""
+                summary["attachments"].append(
+                    {
+                        "file_name": file_name,
+                        "content_type": content_type,
+                        "size": len(payload),
+                        "sha256": hashlib.sha256(payload).hexdigest(),
+                        "md5": hashlib.md5(payload, usedforsecurity=False).hexdigest(),
+                    }
+                )
+            elif content_type in ("text/plain", "text/html"):
+                payload = part.get_payload(decode=True) or b""
+                text = payload[:FIREEYEETP_EMAIL_MAX_TEXT_SIZE].decode(part.get_content_charset() or "utf-8", errors="replace")
+                for url in re.findall(FIREEYEETP_URL_REGEX, text, re.IGNORECASE):
+                    if len(urls) >= FIREEYEETP_EMAIL_MAX_URLS:
+                        break
+                    urls[url.rstrip(".,;")] = None
+        summary["urls"] = list(urls)
+
+        def artifact(name, cef, cef_types, *parts):
+            return {
+                "name": name,
+                "container_id": container_id,
+                "cef": cef,
+                "cef_types": cef_types,
+                "source_data_identifier": fingerprint(email_sha256, name, *parts),
+            }
+
+        artifacts = []
+        headers = {
+            "fromEmail": summary["from"],
+            "toEmail": summary["to"],
+            "ccEmail": summary["cc"],
+            "emailSubject": summary["subject"],
+            "emailDate": summary["date"],
+            "emailMessageId": summary["message_id"],
+            "vaultId": vault_details.get(phantom.APP_JSON_VAULT_ID),
+        }
+        headers = {key: value for key, value in headers.items() if value}
+        if headers:
+            artifacts.append(artifact("Email Headers", headers, {"fromEmail": ["email"], "vaultId": ["vault id"]}, "headers"))
+        for url in summary["urls"]:
+            artifacts.append(artifact("Email URL", {"requestURL": url}, {"requestURL": ["url"]}, url))
+        for attachment in summary["attachments"]:
+            cef = {
+                "fileName": attachment["file_name"],
+                "fileSize": attachment["size"],
+                "fileHashSha256": attachment["sha256"],
+                "fileHashMd5": attachment["md5"],
+            }
+            cef_types = {"fileName": ["file name"], "fileHashSha256": ["sha256", "hash"], "fileHashMd5": ["md5", "hash"]}
+            artifacts.append(artifact("Email Attachment", cef, cef_types, attachment["file_name"], attachment["sha256"]))
+        if summary["sender_ip"]:
+            artifacts.append(artifact("Email Sender IP", {"sourceAddress": summary["sender_ip"]}, {"sourceAddress": ["ip"]}, "sender_ip"))
+
+        return summary, artifacts
+
+    def _get_email_sender_ip(self, message):
+        """This function is used to get the IP address of the server the email was sent from.
+        :param message: Parsed email message
+        :return: first public IP address from the oldest Received header or the X-Originating-IP header, or None
+        """
+        headers = [str(x) for x in reversed(message.get_all("Received") or [])]
+        headers.append(str(message.get("X-Originating-IP") or ""))
+        for value in headers:
+            for ip in re.findall(FIREEYEETP_IP_REGEX, value):
+                try:
+                    if ipaddress.ip_address(ip).is_global:
+                        return ip
+                except ValueError:
+                    continue
+        return None
+
+    def _handle_download_pcap(self, param):
+        # Add an action result object to self (BaseConnector) to represent the action for this param
+        action_result = self.add_action_result(ActionResult(dict(param)))
+
+        alert_id_param = param["alert_id"]
+
+        # make rest call, streaming the file into the vault
+        ret_val, vault_details = self._download_alert_file(alert_id_param, "pcap", self.get_container_id(), action_result)
 
         if phantom.is_fail(ret_val):
             return action_result.get_status()
 
-        # Add the response into the data section
-        action_result.add_data(response)
+        # Add the vault details into the data section
+        action_result.add_data(vault_details)
 
         # Return success, no need to set the message, only the status
         # BaseConnector will create a textual message based off of the summary dictionary
@@ -735,29 +1615,17 @@ class FireeyeEtpConnector(BaseConnector):
 
         alert_id_param = param["alert_id"]
 
-        data = {}
-
-        # Set the file name for the vault
-        try:
-            filename = f"{alert_id_param}_malware.zip"
-        except Exception:
-            return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'alert_id' action parameter")
+        # Check the 'extract_members' parameter
+        extract = {"password": param.get("zip_password")} if param.get("extract_members", False) else None
 
-        endpoint = FIREETEETP_GET_ALERT_MALWARE_FILES_ENDPOINT.format(alertId=quote(str(alert_id_param), safe=""))
-
-        # make rest call
-        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data, stream=True)
+        # make rest call, streaming the file into the vault
+        ret_val, vault_details = self._download_alert_file(alert_id_param, "malware", self.get_container_id(), action_result, extract)
 
         if phantom.is_fail(ret_val):
             return action_result.get_status()
 
-        ret_val, vault_details = self._save_file_to_vault(response, filename, self.get_container_id(), action_result)
-
-        if phantom.is_fail(ret_val):
-            return action_result.get_status()
-
-        # Add the response into the data section
-        action_result.add_data(response)
+        # Add the vault details into the data section
+        action_result.add_data(vault_details)
 
         # Return success, no need to set the message, only the status
         # BaseConnector will create a textual message based off of the summary dictionary
@@ -768,29 +1636,308 @@ class FireeyeEtpConnector(BaseConnector):
 
         alert_id_param = param["alert_id"]
 
-        data = {}
+        # Check the 'extract_members' parameter
+        extract = {"password": param.get("zip_password")} if param.get("extract_members", False) else None
+
+        # make rest call, streaming the file into the vault
+        ret_val, vault_details = self._download_alert_file(alert_id_param, "case", self.get_container_id(), action_result, extract)
+
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        # Add the vault details into the data section
+        action_result.add_data(vault_details)
+
+        # Return success, no need to set the message, only the status
+        # BaseConnector will create a textual message based off of the summary dictionary
+        return action_result.set_status(phantom.APP_SUCCESS)
+
+    def _download_alert_file(self, alert_id, file_type, container_id, action_result, extract=None):
+        """This function is used to stream a file of an alert into the vault, adding the files inside it to the vault if asked to.
+        :param alert_id: ID of the alert
+        :param file_type: Type of the file, one of FIREEYEETP_ALERT_FILE_TYPES
+        :param container_id: ID of the container to add the file to
+        :param action_result: Action result object
+        :param extract: None, or dict with the 'password' of the archive to add the files inside malware and case archives
+        :return: status success/failure, vault details with the size and SHA-256 of the file
+        """
+        ret_val, vault_details = self._get_alert_file(alert_id, file_type, container_id, action_result)
+        if phantom.is_fail(ret_val) or extract is None or file_type not in FIREEYEETP_ZIP_FILE_TYPES:
+            return ret_val, vault_details
+
+        # The archive is kept in the vault even when its files cannot be read
+        ret_val, members, skipped = self._extract_zip_members(vault_details, container_id, extract.get("password"), action_result)
+        if phantom.is_fail(ret_val):
+            vault_details["members_error"] = action_result.get_message()
+        else:
+            vault_details["members"] = members
+            vault_details["members_skipped"] = skipped
+
+        return phantom.APP_SUCCESS, vault_details
+
+    def _get_alert_file(self, alert_id, file_type, container_id, action_result):
+        """This function is used to stream a file of an alert into the vault, unless the vault already has it.
+        :param alert_id: ID of the alert
+        :param file_type: Type of the file, one of FIREEYEETP_ALERT_FILE_TYPES
+        :param container_id: ID of the container to add the file to
+        :param action_result: Action result object
+        :return: status success/failure, vault details with the size and SHA-256 of the file
+        """
+        endpoint_format, filename_format = FIREEYEETP_ALERT_FILE_TYPES[file_type]
 
         # Set the file name for the vault
         try:
-            filename = f"{alert_id_param}_case.zip"
+            filename = filename_format.format(alertId=alert_id)
+            endpoint = endpoint_format.format(alertId=quote(str(alert_id), safe=""))
         except Exception:
-            return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'alert_id' action parameter")
+            return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'alert_id' action parameter"), None
+
+        # The file of an alert does not change, look for it in the vault before downloading it
+        if container_id:
+            file_name = self._get_safe_filename(filename)
+            existing = self._find_vault_file(container_id, file_name=file_name)
+            if existing:
+                return phantom.APP_SUCCESS, self._get_vault_details(existing)
+
+            existing = self._find_vault_file(file_name=file_name)
+            if existing and existing.get("path") and os.path.isfile(existing["path"]):
+                ret_val, vault_details = self._copy_vault_file(existing, container_id, action_result)
+                if phantom.is_success(ret_val):
+                    return ret_val, vault_details
+                self.debug_print(f"Unable to copy the vault file {existing.get('vault_id')}, downloading it")
+
+        return self._download_file_to_vault(endpoint, filename, container_id, action_result, json={})
+
+    def _download_alert_file_entry(self, alert_id, file_type, container_id, extract=None):
+        """This function is used to download a file of an alert with its own action result so that it can run in a worker thread.
+        :param alert_id: ID of the alert
+        :param file_type: Type of the file, one of FIREEYEETP_ALERT_FILE_TYPES
+        :param container_id: ID of the container to add the file to
+        :param extract: None, or dict with the 'password' of the archive to add the files inside malware and case archives
+        :return: manifest entry of the file
+        """
+        entry = {"alert_id": alert_id, "file_type": file_type}
 
-        endpoint = FIREETEETP_GET_ALERT_CASE_FILES_ENDPOINT.format(alertId=quote(str(alert_id_param), safe=""))
+        file_result = ActionResult()
+        ret_val, vault_details = self._download_alert_file(alert_id, file_type, container_id, file_result, extract)
+        if phantom.is_fail(ret_val):
+            entry.update({"status": "failed", "message": file_result.get_message()})
+        else:
+            entry["status"] = "success"
+            entry.update(vault_details)
+
+        return entry
+
+    def _extract_zip_members(self, vault_details, container_id, password, action_result):
+        """This function is used to read a zip archive in the vault one file at a time, hashing every file
+        and adding the executables, documents and emails to the vault with a hash artifact.
+        Files are streamed in chunks and the zip bomb limits are checked before and while reading them.
+        Only the first FIREEYEETP_ZIP_MAX_MEMBERS files are read, the others are only counted.
+        :param vault_details: Vault details of the archive
+        :param container_id: ID of the container to add the files and artifacts to
+        :param password: Password of the archive, or None
+        :param action_result: Action result object
+        :return: status success/failure, list with the name, size, hashes and vault ID or skip reason of each file read,
+                 number of files not read
+        """
+        info = self._find_vault_file(vault_id=vault_details.get(phantom.APP_JSON_VAULT_ID), container_id=container_id)
+        if not info or not info.get("path"):
+            return action_result.set_status(phantom.APP_ERROR, "Unable to find the archive in the vault"), None, None
 
-        # make rest call
-        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data, stream=True)
+        try:
+            archive = zipfile.ZipFile(info["path"])
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            return action_result.set_status(phantom.APP_ERROR, f"Unable to read the archive. {err}"), None, None
+
+        members = []
+        artifacts = []
+        total_size = 0
+        with archive:
+            if password:
+                archive.setpassword(str(password).encode("utf-8"))
+
+            files = [member for member in archive.infolist() if not member.is_dir()]
+            skipped = max(len(files) - FIREEYEETP_ZIP_MAX_MEMBERS, 0)
+            if skipped:
+                self.debug_print(f"The archive holds {len(files)} files, only the first {FIREEYEETP_ZIP_MAX_MEMBERS} are read")
+
+            for member in files[:FIREEYEETP_ZIP_MAX_MEMBERS]:
+                entry = {"name": member.filename, "size": member.file_size}
+                members.append(entry)
+
+                # Check the sizes declared in the archive before reading anything
+                reason = None
+                if member.file_size > FIREEYEETP_ZIP_MAX_MEMBER_SIZE:
+                    reason = "file too large"
+                elif total_size + member.file_size > FIREEYEETP_ZIP_MAX_TOTAL_SIZE:
+                    reason = "archive too large"
+                elif member.file_size > FIREEYEETP_ZIP_MAX_RATIO * max(member.compress_size, 1):
+                    reason = "compression ratio too high"
+                if reason:
+                    entry.update({"status": "skipped", "reason": reason})
+                    continue
+
+                ret_val, result = self._read_zip_member(archive, member, container_id)
+                if phantom.is_fail(ret_val):
+                    entry.update({"status": "skipped", "reason": result})
+                    continue
+
+                total_size += result["size"]
+                entry.update(result)
+                if entry.get(phantom.APP_JSON_VAULT_ID):
+                    artifacts.append(self._create_zip_member_artifact(vault_details, entry, container_id))
 
+        if artifacts:
+            ret_val, message, _ = self.save_artifacts(artifacts)
+            if phantom.is_fail(ret_val):
+                self.debug_print(f"Unable to save the artifacts of the files in the archive. {message}")
+
+        return phantom.APP_SUCCESS, members, skipped
+
+    def _read_zip_member(self, archive, member, container_id):
+        """This function is used to stream a file out of a zip archive, hashing it and adding it to the vault if it is of a selected type.
+        :param archive: Open ZipFile
+        :param member: ZipInfo of the file
+        :param container_id: ID of the container to add the file to
+        :return: status success/failure, dict with the size, hashes, status and vault details, or the reason it was skipped
+        """
+        name = os.path.basename(member.filename)
+        selected = os.path.splitext(name)[1].lower() in FIREEYEETP_ZIP_MEMBER_EXTENSIONS
+
+        tmp_file = None
+        file_result = ActionResult()
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5(usedforsecurity=False)
+        size = 0
+        try:
+            with archive.open(member) as member_file:
+                first_chunk = member_file.read(FIREEYEETP_DOWNLOAD_CHUNK_SIZE)
+                selected = selected or first_chunk.startswith(FIREEYEETP_ZIP_MEMBER_MAGIC)
+
+                if selected:
+                    ret_val, tmp_file = self._create_vault_tmp_file(name, file_result)
+                    if phantom.is_fail(ret_val):
+                        return phantom.APP_ERROR, file_result.get_message()
+
+                with open(tmp_file["file_path"], "wb") if tmp_file else open(os.devnull, "wb") as file_obj:
+                    chunk = first_chunk
+                    while chunk:
+                        size += len(chunk)
+                        # The declared size can be forged, stop reading past it
+                        if size > member.file_size:
+                            raise ValueError("the file is larger than declared in the archive")
+                        sha256.update(chunk)
+                        md5.update(chunk)
+                        file_obj.write(chunk)
+                        chunk = member_file.read(FIREEYEETP_DOWNLOAD_CHUNK_SIZE)
+        except Exception as e:
+            if tmp_file:
+                shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            return phantom.APP_ERROR, self._get_error_message_from_exception(e)
+
+        result = {"size": size, "sha256": sha256.hexdigest(), "md5": md5.hexdigest(), "status": "hashed"}
+        if not tmp_file:
+            return phantom.APP_SUCCESS, result
+
+        # The same file already in the container is not stored again
+        existing = self._find_vault_file(container_id, sha256=result["sha256"])
+        if existing:
+            shutil.rmtree(tmp_file["temp_dir"], ignore_errors=True)
+            result.update({phantom.APP_JSON_VAULT_ID: existing.get("vault_id"), "status": "added"})
+            return phantom.APP_SUCCESS, result
+
+        ret_val, vault_details = self._add_file_to_vault(tmp_file, container_id, file_result)
         if phantom.is_fail(ret_val):
-            return action_result.get_status()
+            return phantom.APP_ERROR, file_result.get_message()
 
-        ret_val, vault_details = self._save_file_to_vault(response, filename, self.get_container_id(), action_result)
+        result.update({phantom.APP_JSON_VAULT_ID: vault_details[phantom.APP_JSON_VAULT_ID], "status": "added"})
+        return phantom.APP_SUCCESS, result
+
+    def _create_zip_member_artifact(self, vault_details, entry, container_id):
+        """This function is used to create the hash artifact of a file added to the vault from an archive.
+        :param vault_details: Vault details of the archive
+        :param entry: Name, size, hashes and vault ID of the file
+        :param container_id: ID of the container to add the artifact to
+        :return: artifact
+        """
+        artifact = {
+            "name": "Archive File",
+            "container_id": container_id,
+            "cef": {
+                "fileName": entry["name"],
+                "fileSize": entry["size"],
+                "fileHashSha256": entry["sha256"],
+                "fileHashMd5": entry["md5"],
+                "vaultId": entry[phantom.APP_JSON_VAULT_ID],
+                "archiveVaultId": vault_details.get(phantom.APP_JSON_VAULT_ID),
+            },
+            "cef_types": {
+                "fileName": ["file name"],
+                "fileHashSha256": ["sha256", "hash"],
+                "fileHashMd5": ["md5", "hash"],
+                "vaultId": ["vault id"],
+                "archiveVaultId": ["vault id"],
+            },
+        }
+        artifact["source_data_identifier"] = fingerprint(vault_details.get("sha256"), entry["name"], entry["sha256"])
+        return artifact
 
+    def _handle_download_alert_files(self, param):
+        action_result = self.add_action_result(ActionResult(dict(param)))
+
+        # Check the 'alert_ids' parameter
+        try:
+            alert_ids = [x.strip() for x in param.get("alert_ids", "").split(",")]
+            alert_ids = list(OrderedDict.fromkeys(_f for _f in alert_ids if _f))
+        except Exception:
+            alert_ids = []
+        if not alert_ids:
+            return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'alert_ids' action parameter")
+
+        # Check the 'file_types' parameter
+        try:
+            file_types = [x.strip().lower() for x in param.get("file_types", ",".join(FIREEYEETP_ALERT_FILE_TYPES)).split(",")]
+            file_types = list(OrderedDict.fromkeys(_f for _f in file_types if _f))
+        except Exception:
+            file_types = []
+        if not file_types or any(file_type not in FIREEYEETP_ALERT_FILE_TYPES for file_type in file_types):
+            return action_result.set_status(phantom.APP_ERROR, FIREEYEETP_FILE_TYPES_ERR)
+
+        # Check the 'max_workers' parameter
+        ret_val, max_workers = self._validate_integer(action_result, param.get("max_workers", FIREEYEETP_DEFAULT_MAX_WORKERS), MAX_WORKERS_KEY)
         if phantom.is_fail(ret_val):
             return action_result.get_status()
 
-        # Add the response into the data section
-        action_result.add_data(response)
+        # All the files come from the same host, the connection pool of the session is the limit per host
+        files = [(alert_id, file_type) for alert_id in alert_ids for file_type in file_types]
+        max_workers = min(max_workers, self._pool_maxsize, len(files))
+        self.save_progress(f"Downloading {len(files)} files with {max_workers} workers")
+
+        # Check the 'extract_members' parameter
+        extract = {"password": param.get("zip_password")} if param.get("extract_members", False) else None
+
+        container_id = self.get_container_id()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self._download_alert_file_entry, alert_id, file_type, container_id, extract) for alert_id, file_type in files
+            ]
+
+            # The manifest keeps the order of the alerts and file types, a failed download does not fail the others
+            failed = 0
+            total_size = 0
+            for future in futures:
+                entry = future.result()
+                if entry["status"] == "success":
+                    total_size += entry.get("size") or 0
+                else:
+                    failed += 1
+                action_result.add_data(entry)
+
+        action_result.update_summary({"total_files": len(files), "files_failed": failed, "total_size": total_size})
+
+        if failed == len(files):
+            return action_result.set_status(phantom.APP_ERROR, "Unable to download any of the files")
 
         # Return success, no need to set the message, only the status
         # BaseConnector will create a textual message based off of the summary dictionary
@@ -822,7 +1969,7 @@ class FireeyeEtpConnector(BaseConnector):
         endpoint = FIREETEETP_REMEDIATE_EMAILS_ENDPOINT
 
         # make rest call
-        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data)
+        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data, retry_server_errors=False)
 
         if phantom.is_fail(ret_val):
             return action_result.get_status()
@@ -846,6 +1993,10 @@ class FireeyeEtpConnector(BaseConnector):
 
         endpoint = FIREEYEETP_GET_QUARANTINED_EMAIL_ENDPOINT.format(etp_message_id=quote(str(etp_message_id_param), safe=""))
 
+        # Parse the email while it is streamed to the vault, only the parsed summary is added to the data section
+        if param.get("parse_email", False):
+            return self._download_and_parse_email(endpoint, filename, action_result)
+
         # make rest call
         ret_val, response = self._make_rest_call(endpoint, action_result)
 
@@ -892,7 +2043,7 @@ class FireeyeEtpConnector(BaseConnector):
             data["headers_only"] = headers_only_param
 
         # make rest call
-        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data)
+        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data, retry_server_errors=False)
 
         if phantom.is_fail(ret_val):
             return action_result.get_status()
@@ -924,7 +2075,7 @@ class FireeyeEtpConnector(BaseConnector):
             return action_result.set_status(phantom.APP_ERROR, "Please provide a valid value in 'etp_message_id' action parameter")
 
         # make rest call
-        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data)
+        ret_val, response = self._make_rest_call(endpoint, action_result, method="post", json=data, retry_server_errors=False)
 
         if phantom.is_fail(ret_val):
             return action_result.get_status()
@@ -1080,9 +2231,11 @@ class FireeyeEtpConnector(BaseConnector):
         endpoint = FIREEYEETP_LIST_QUARANTINED_EMAILS_ENDPOINT
 
         # make rest call
-        ret_val, response = self._paginator(endpoint, action_result, data, method="post")
-        if phantom.is_fail(ret_val):
-            return action_result.get_status()
+        response = []
+        for ret_val, emails in self._paginate(endpoint, action_result, data, method="post"):
+            if phantom.is_fail(ret_val):
+                return action_result.get_status()
+            response.extend(emails)
 
         # Add the response into the data section
         action_result.add_data(response)
@@ -1106,6 +2259,44 @@ class FireeyeEtpConnector(BaseConnector):
         # Get config
         config = self.get_config()
 
+        ret_val, batch_size = self._validate_integer(
+            action_result, config.get("container_batch_size", FIREEYEETP_DEFAULT_CONTAINER_BATCH_SIZE), CONTAINER_BATCH_SIZE_KEY
+        )
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        ret_val, index_size = self._validate_integer(
+            action_result, config.get("seen_alert_index_size", FIREEYEETP_DEFAULT_SEEN_ALERT_INDEX_SIZE), SEEN_ALERT_INDEX_SIZE_KEY, True
+        )
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        ret_val, prefetch = self._validate_integer(
+            action_result, config.get("prefetch_pages", FIREEYEETP_DEFAULT_PREFETCH_PAGES), PREFETCH_PAGES_KEY, True
+        )
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        modified_alerts = config.get("modified_alerts", FIREEYEETP_MODIFIED_ALERTS_UPDATE)
+        if modified_alerts not in FIREEYEETP_MODIFIED_ALERTS_VALUES:
+            return action_result.set_status(phantom.APP_ERROR, FIREEYEETP_MODIFIED_ALERTS_ERR)
+
+        ret_val, time_budget = self._validate_integer(action_result, config.get("poll_time_budget", 0), POLL_TIME_BUDGET_KEY, True)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        ret_val, filters = self._get_poll_filters(action_result, config)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+        if filters["attributes"]:
+            data["attributes"] = dict(filters["attributes"])
+
+        priority = config.get("poll_priority", False)
+
+        ret_val, grouping = self._get_alert_grouping(action_result, config, index_size)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
         try:
             # Get the endtime from Phantom which is when the action was ran
             timestamp = datetime.utcfromtimestamp(param.get(phantom.APP_JSON_END_TIME) / 1000.0)
@@ -1114,6 +2305,9 @@ class FireeyeEtpConnector(BaseConnector):
         else:
             timestamp = datetime.utcnow()
 
+        # Only scheduled polls after the first run are bounded by a time budget
+        deadline = None
+
         # If it is a manual poll or first run
         if self.is_poll_now() or self._state.get("first_run", True):
             try:
@@ -1130,7 +2324,12 @@ class FireeyeEtpConnector(BaseConnector):
 
         # If it is a scheduled poll, ingest from last_ingestion_time
         else:
-            limit = data["size"]
+            # The time budget bounds a scheduled poll, the container count is only an upper limit
+            limit = param.get(phantom.APP_JSON_CONTAINER_COUNT)
+            if limit is not None:
+                ret_val, limit = self._validate_integer(action_result, limit, CONTAINER_COUNT_KEY)
+                if phantom.is_fail(ret_val):
+                    return action_result.get_status()
             try:
                 # Get the ingestion interval
                 # If interval is not present just get the last 15 minutes
@@ -1138,6 +2337,11 @@ class FireeyeEtpConnector(BaseConnector):
             except Exception:
                 return action_result.set_status(phantom.APP_ERROR, "Ingestion interval is invalid")
 
+            # Leave part of the interval unused so that a run ends before the next one is scheduled
+            if not time_budget:
+                time_budget = max(int(interval_mins * 60 * FIREEYEETP_POLL_BUDGET_RATIO), FIREEYEETP_MIN_POLL_BUDGET)
+            deadline = time.monotonic() + time_budget
+
             # Try to get the last_ingestion_time from the state file
             # If not get the last x minutes which is determined by the interval
             date = self._state.get(
@@ -1145,56 +2349,772 @@ class FireeyeEtpConnector(BaseConnector):
             )
             data["fromLastModifiedOn"] = date
 
-        endpoint = FIREETEETP_LIST_ALERTS_ENDPOINT
-
-        # make rest call
-        ret_val, response = self._paginator2(endpoint, action_result, data, limit=limit, method="post")
-
-        if phantom.is_fail(ret_val):
-            return action_result.get_status()
+        live_start = data["fromLastModifiedOn"]
+        progress = {}
 
-        # Start creating events and artifacts
-        if response:
-            if self.is_poll_now() or self._state.get("first_run", True):
-                # If we want to get a limited of alerts then just return the list with that number of items
-                response = response[-limit:]
+        # Alerts already ingested by a previous poll come back when they are modified
+        seen_alerts = None
+        if index_size:
+            seen_alerts = ContainerIndex(os.path.join(self.get_state_dir(), f"{self.get_asset_id()}_seen_alerts.json"), index_size)
+            seen_alerts.load()
 
-            self.save_progress(f"Ingesting {len(response)} alerts")
+        ingest = self._new_ingest(batch_size, seen_alerts, modified_alerts)
+        ingest["prefetch"] = prefetch
+        ingest["filters"] = filters
+        ingest.update(grouping)
 
-            for alert in response:
-                # Create a container for each alert
-                container_dict = self._create_container(action_result, alert)
-                artifacts = self._create_artifacts(alert=alert)
-                container_dict["artifacts"] = artifacts
+        # The watermark of a scheduled poll is the newest ingested modification time and the IDs of the alerts modified at that time
+        if not self.is_poll_now():
+            ingest["watermark"] = {
+                "time": live_start,
+                "ids": list(self._state.get("last_ingestion_ids", [])) if self._state.get("last_ingestion_time") else [],
+                "state": self._state,
+                "time_key": "last_ingestion_time",
+                "ids_key": "last_ingestion_ids",
+            }
+            ingest["deadline"] = deadline
 
-                container_creation_status, container_creation_msg, container_id = self.save_container(container=container_dict)
+        # make rest call
+        ret_val, pages = self._get_poll_pages(action_result, data, limit, priority, ingest, progress)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
 
-                if phantom.is_fail(container_creation_status):
-                    self.debug_print(container_creation_msg)
-                    self.save_progress(
-                        "Error while creating container for alert {alert_name}. {error_message}".format(
-                            alert_name=container_dict["name"], error_message=container_creation_msg
-                        )
-                    )
-                    return action_result.set_status(phantom.APP_ERROR), None
+        # Start creating events and artifacts, one page at a time
+        start_time = time.monotonic()
+        ret_val, total_alerts = self._ingest_pages(pages, ingest, action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
 
-        else:
+        if not total_alerts:
             self.save_progress("No alerts found")
 
+        elapsed = time.monotonic() - start_time
+        action_result.update_summary(
+            {
+                "containers_saved": ingest["saved"],
+                "containers_failed": ingest["failed"],
+                "containers_per_second": round(ingest["saved"] / elapsed, 2) if elapsed else ingest["saved"],
+                "alerts_updated": ingest["updated"],
+                "alerts_skipped": ingest["skipped"],
+                "alerts_filtered": ingest["filtered"],
+                "alerts_grouped": ingest["grouped"],
+            }
+        )
+
         # Mark the first_run as False once the scheduled or ingestion polling
         # first run or every run has been successfully completed
         if not self.is_poll_now():
             self._state["first_run"] = False
+        self._checkpoint_watermark(ingest)
 
-        self._state["last_ingestion_time"] = data["fromLastModifiedOn"]
+        action_result.update_summary({"total_alerts": total_alerts})
 
-        # Add the response into the data section
-        action_result.add_data(response)
+        if not self.is_poll_now():
+            # The next scheduled poll resumes from the checkpointed watermark
+            if ingest["deadline_reached"] or progress.get("stop_reason") in ("deadline", "max_items"):
+                self._report_backlog(action_result, ingest)
+                return action_result.set_status(phantom.APP_SUCCESS)
+
+            # Use what is left of the run for the historical backfill
+            ret_val = self._run_backfill(action_result, config, live_start, ingest)
+            if phantom.is_fail(ret_val):
+                return action_result.get_status()
 
         # Return success, no need to set the message, only the status
         # BaseConnector will create a textual message based off of the summary dictionary
         return action_result.set_status(phantom.APP_SUCCESS)
 
+    def _get_alert_grouping(self, action_result, config, index_size):
+        """This function is used to get the alert grouping of polling from the asset configuration.
+        Alerts of the same group go to the container created for the first of them, also across polls.
+        :param action_result: Action result object
+        :param config: Asset configuration
+        :param index_size: Number of ingested alert IDs remembered, also used for the number of groups remembered
+        :return: status success/failure, dict of the grouping settings of the ingestion state
+        """
+        group_by = config.get("group_alerts_by") or FIREEYEETP_GROUP_BY_NONE
+        if group_by not in FIREEYEETP_GROUP_BY_VALUES:
+            return RetVal(action_result.set_status(phantom.APP_ERROR, FIREEYEETP_GROUP_BY_ERR), None)
+
+        ret_val, group_window = self._validate_integer(
+            action_result, config.get("group_window_mins", FIREEYEETP_DEFAULT_GROUP_WINDOW_MINS), GROUP_WINDOW_MINS_KEY
+        )
+        if phantom.is_fail(ret_val):
+            return RetVal(action_result.get_status(), None)
+
+        if group_by == FIREEYEETP_GROUP_BY_NONE:
+            return RetVal(phantom.APP_SUCCESS, {})
+
+        groups = ContainerIndex(
+            os.path.join(self.get_state_dir(), f"{self.get_asset_id()}_alert_groups.json"),
+            index_size or FIREEYEETP_DEFAULT_SEEN_ALERT_INDEX_SIZE,
+        )
+        groups.load()
+        return RetVal(phantom.APP_SUCCESS, {"groups": groups, "group_by": group_by, "group_window": group_window})
+
+    def _get_poll_pages(self, action_result, data, limit, priority, ingest, progress):
+        """This function is used to request the alerts of a poll.
+        Poll Now and the first run keep the latest alerts up to the limit, scheduled polls page through the alerts
+        until the limit or the time budget is reached. With priority, only the most important alerts are returned.
+        :param action_result: Action result object
+        :param data: dict of parameters to send to the API endpoint
+        :param limit: Number of alerts to ingest, None for no limit
+        :param priority: Whether to rank the alerts, see _rank_poll_alerts
+        :param ingest: Ingestion state created by _new_ingest
+        :param progress: dict updated with the progress of the pagination of a scheduled poll
+        :return: status success/failure, iterable of status and list of alerts
+        """
+        endpoint = FIREETEETP_LIST_ALERTS_ENDPOINT
+
+        # Alerts ranked below the poll limit by an earlier scheduled poll are ranked again with the new ones
+        deferred_path = os.path.join(self.get_state_dir(), f"{self.get_asset_id()}_deferred_alerts.json")
+        deferred = self._load_deferred_alerts(deferred_path) if priority and not self.is_poll_now() else []
+
+        if self.is_poll_now() or self._state.get("first_run", True):
+            pages = self._paginate(endpoint, action_result, data, method="post")
+            if not priority:
+                # If we want to get a limited number of alerts, only keep the latest ones
+                latest_alerts = deque(maxlen=limit)
+                for ret_val, alerts in pages:
+                    if phantom.is_fail(ret_val):
+                        return RetVal(action_result.get_status(), None)
+                    latest_alerts.extend(alerts)
+                return RetVal(phantom.APP_SUCCESS, [RetVal(phantom.APP_SUCCESS, list(latest_alerts))] if latest_alerts else [])
+        else:
+            max_items = limit
+            if priority:
+                # Only request as many alerts as can be ingested or deferred, the rest stays after the watermark
+                limit = limit or data["size"]
+                max_items = max(limit + FIREEYEETP_MAX_DEFERRED_ALERTS - len(deferred), limit)
+            pages = self._paginate(
+                endpoint, action_result, data, method="post", max_items=max_items, deadline=ingest["deadline"], progress=progress
+            )
+            pages = self._prefetch_pages(pages, ingest["prefetch"], action_result)
+
+        if not priority:
+            return RetVal(phantom.APP_SUCCESS, pages)
+
+        return self._rank_poll_alerts(pages, deferred, deferred_path, limit, ingest, action_result)
+
+    def _rank_poll_alerts(self, pages, deferred, deferred_path, limit, ingest, action_result):
+        """This function is used to rank all the candidate alerts of a poll, so that the most important ones are ingested first.
+        The next most important alerts are kept for the next scheduled poll, Poll Now has no next poll and drops them.
+        :param pages: Iterable of status and list of alerts
+        :param deferred: List of the alerts deferred by the previous poll
+        :param deferred_path: Path of the file holding the deferred alerts
+        :param limit: Number of alerts to ingest
+        :param ingest: Ingestion state created by _new_ingest
+        :param action_result: Action result object
+        :return: status success/failure, list with the page of the alerts to ingest
+        """
+        ret_val, ranked = self._prioritize_alerts(pages, deferred, limit, ingest, action_result)
+        if phantom.is_fail(ret_val):
+            return RetVal(action_result.get_status(), None)
+        ingest["prioritized"] = True
+
+        # The deferred alerts are kept before the watermark moves past them
+        if self.is_poll_now():
+            ingest["dropped"] += len(ingest["deferred"])
+            ingest["deferred"] = []
+        else:
+            self._save_deferred_alerts(deferred_path, ingest["deferred"])
+        action_result.update_summary({"alerts_deferred": len(ingest["deferred"]), "alerts_dropped": ingest["dropped"]})
+
+        return RetVal(phantom.APP_SUCCESS, [RetVal(phantom.APP_SUCCESS, ranked)] if ranked else [])
+
+    def _ingest_pages(self, pages, ingest, action_result):
+        """This function is used to ingest pages of alerts, committing and checkpointing the watermark after each page
+        so that a restart resumes after the last committed page.
+        :param pages: Iterable of status and list of alerts
+        :param ingest: Ingestion state created by _new_ingest
+        :param action_result: Action result object
+        :return: status success/failure, number of alerts received
+        """
+        total_alerts = 0
+        for ret_val, alerts in pages:
+            if phantom.is_fail(ret_val):
+                self._flush_ingest(ingest)
+                self._checkpoint_watermark(ingest)
+                return action_result.get_status(), total_alerts
+
+            self.save_progress(f"Ingesting {len(alerts)} alerts")
+            total_alerts += len(alerts)
+
+            for alert in alerts:
+                # Alerts at the watermark time are returned again by the next poll
+                if not ingest["prioritized"] and self._is_below_watermark(ingest, alert):
+                    ingest["skipped"] += 1
+                    continue
+
+                # Filtered alerts still move the watermark so that they are not requested again
+                if self._alert_matches_filters(alert, ingest["filters"]):
+                    self._queue_alert(ingest, alert, action_result)
+                else:
+                    ingest["filtered"] += 1
+                self._advance_watermark(ingest, alert)
+
+            # Commit the page and checkpoint the watermark so that a restart resumes after it
+            self._flush_ingest(ingest)
+            self._checkpoint_watermark(ingest)
+
+            # Stop at the page boundary once the time budget of the run is spent
+            if ingest["deadline"] is not None and time.monotonic() >= ingest["deadline"]:
+                ingest["deadline_reached"] = True
+                close = getattr(pages, "close", None)
+                if close:
+                    close()
+                return phantom.APP_SUCCESS, total_alerts
+
+        # Every page was taken, whatever a prefetching producer reported while they were ingested
+        ingest["pages_consumed"] = True
+        return phantom.APP_SUCCESS, total_alerts
+
+    def _report_backlog(self, action_result, ingest):
+        """This function is used to add the number of alerts left after the watermark to the summary
+        of a run that stopped before all the alerts were ingested.
+        :param action_result: Action result object
+        :param ingest: Ingestion state created by _new_ingest
+        """
+        summary = {"stopped_early": True}
+        try:
+            start = datetime.strptime(ingest["watermark"]["time"], "%Y-%m-%dT%H:%M:%S.%f")
+        except Exception:
+            start = None
+
+        if start is not None:
+            data = {"attributes": dict(ingest["filters"]["attributes"])} if ingest["filters"] and ingest["filters"]["attributes"] else {}
+            ret_val, total = self._count_alerts(data, start, None)
+            if phantom.is_fail(ret_val):
+                self.debug_print(f"Unable to get the number of alerts left: {total}")
+            else:
+                # Alerts at the watermark time that were already ingested are included in the total
+                summary["alerts_remaining"] = total
+
+        action_result.update_summary(summary)
+        self.save_progress(f"Stopped before all alerts were ingested, {summary.get('alerts_remaining', 'unknown')} alerts remaining")
+
+    def _run_backfill(self, action_result, config, live_start, live_ingest):
+        """This function is used to ingest a slice of the configured historical range, within a time and container budget.
+        The backfill cursor is kept in the state file so that successive scheduled polls walk the whole range.
+        :param action_result: Action result object
+        :param config: Asset configuration
+        :param live_start: Time the live ingestion started from, used as the end of the range when the backfill starts
+        :param live_ingest: Ingestion state of the live ingestion, its settings are reused
+        :return: status success/failure
+        """
+        ret_val, backfill_days = self._validate_integer(action_result, config.get("backfill_days", 0), BACKFILL_DAYS_KEY, True)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        if not backfill_days:
+            return phantom.APP_SUCCESS
+
+        ret_val, max_containers = self._validate_integer(
+            action_result, config.get("backfill_max_containers", FIREEYEETP_DEFAULT_BACKFILL_MAX_CONTAINERS), BACKFILL_MAX_CONTAINERS_KEY
+        )
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        ret_val, max_seconds = self._validate_integer(
+            action_result, config.get("backfill_max_seconds", FIREEYEETP_DEFAULT_BACKFILL_MAX_SECONDS), BACKFILL_MAX_SECONDS_KEY
+        )
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        # Start a new backfill when none was started or the range changed
+        backfill = self._state.get("backfill")
+        if not isinstance(backfill, dict) or backfill.get("days") != backfill_days:
+            try:
+                end = datetime.strptime(live_start, "%Y-%m-%dT%H:%M:%S.%f")
+            except Exception:
+                end = datetime.utcnow()
+            backfill = {
+                "days": backfill_days,
+                "end": end.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
+                "cursor": (end - timedelta(days=backfill_days)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
+                "ids": [],
+                "done": False,
+            }
+            self._state["backfill"] = backfill
+
+        if backfill.get("done"):
+            action_result.update_summary({"backfill_done": True})
+            return phantom.APP_SUCCESS
+
+        ingest = self._new_ingest(live_ingest["batch_size"], live_ingest["seen_alerts"], live_ingest["modified_alerts"])
+        ingest["prefetch"] = live_ingest["prefetch"]
+        ingest["filters"] = live_ingest["filters"]
+        ingest["groups"] = live_ingest["groups"]
+        ingest["group_by"] = live_ingest["group_by"]
+        ingest["group_window"] = live_ingest["group_window"]
+        # The backfill only gets what is left of the time budget of the run
+        ingest["deadline"] = time.monotonic() + max_seconds
+        if live_ingest["deadline"] is not None:
+            ingest["deadline"] = min(ingest["deadline"], live_ingest["deadline"])
+        if time.monotonic() >= ingest["deadline"]:
+            return phantom.APP_SUCCESS
+        ingest["watermark"] = {"time": backfill["cursor"], "ids": backfill["ids"], "state": backfill, "time_key": "cursor", "ids_key": "ids"}
+
+        self.save_progress(f"Backfilling alerts from {backfill['cursor']} to {backfill['end']}")
+
+        data = {"size": 200, "fromLastModifiedOn": backfill["cursor"], "toLastModifiedOn": backfill["end"]}
+        if ingest["filters"] and ingest["filters"]["attributes"]:
+            data["attributes"] = dict(ingest["filters"]["attributes"])
+        progress = {}
+        pages = self._paginate(
+            FIREETEETP_LIST_ALERTS_ENDPOINT,
+            action_result,
+            data,
+            method="post",
+            max_items=max_containers,
+            deadline=ingest["deadline"],
+            progress=progress,
+        )
+        pages = self._prefetch_pages(pages, live_ingest["prefetch"], action_result)
+        ret_val, _ = self._ingest_pages(pages, ingest, action_result)
+        if phantom.is_fail(ret_val):
+            return action_result.get_status()
+
+        # The range is only done once the last page of it was ingested, not just fetched
+        if progress.get("stop_reason") == "exhausted" and ingest["pages_consumed"] and not ingest["deadline_reached"]:
+            backfill["done"] = True
+            self.save_state(self._state)
+
+        action_result.update_summary(
+            {
+                "backfill_containers_saved": ingest["saved"],
+                "backfill_cursor": backfill["cursor"],
+                "backfill_done": backfill["done"],
+            }
+        )
+
+        return phantom.APP_SUCCESS
+
+    def _new_ingest(self, batch_size, seen_alerts=None, modified_alerts=FIREEYEETP_MODIFIED_ALERTS_UPDATE):
+        """This function is used to create the state of an ingestion run.
+        :param batch_size: Number of containers or artifacts saved per platform call
+        :param seen_alerts: ContainerIndex of the alerts already ingested, or None
+        :param modified_alerts: What to do with an alert already ingested, 'update' or 'skip'
+        :return: dict holding the pending containers and artifacts and the counters of the run
+        """
+        return {
+            "batch_size": batch_size,
+            "seen_alerts": seen_alerts,
+            "modified_alerts": modified_alerts,
+            "containers": [],
+            "alert_ids": [],
+            "queued_ids": set(),
+            "artifacts": [],
+            "saved": 0,
+            "failed": 0,
+            "updated": 0,
+            "skipped": 0,
+            "watermark": None,
+            "prefetch": 0,
+            "deadline": None,
+            "deadline_reached": False,
+            "pages_consumed": False,
+            "filters": None,
+            "filtered": 0,
+            "prioritized": False,
+            "groups": None,
+            "group_by": FIREEYEETP_GROUP_BY_NONE,
+            "group_window": FIREEYEETP_DEFAULT_GROUP_WINDOW_MINS,
+            "group_keys": [],
+            "pending_groups": {},
+            "grouped": 0,
+            "deferred": [],
+            "dropped": 0,
+        }
+
+    def _get_alert_modified_time(self, alert):
+        """This function is used to get the last modification time of an alert, used as the polling watermark.
+        :param alert: Data of single alert
+        :return: last modification time string or None
+        """
+        try:
+            return alert.get("attributes", {}).get("meta", {}).get("last_modified_on")
+        except Exception:
+            return None
+
+    def _is_below_watermark(self, ingest, alert):
+        """This function is used to check if an alert was already ingested up to the watermark.
+        :param ingest: Ingestion state created by _new_ingest
+        :param alert: Data of single alert
+        :return: True if the alert was already ingested
+        """
+        watermark = ingest["watermark"]
+        modified_time = self._get_alert_modified_time(alert)
+        if not watermark or not modified_time or not watermark["ids"]:
+            return False
+
+        return modified_time < watermark["time"] or (modified_time == watermark["time"] and alert.get("id") in watermark["ids"])
+
+    def _advance_watermark(self, ingest, alert):
+        """This function is used to move the watermark to an ingested alert if it is newer.
+        :param ingest: Ingestion state created by _new_ingest
+        :param alert: Data of single alert
+        """
+        watermark = ingest["watermark"]
+        modified_time = self._get_alert_modified_time(alert)
+        if not watermark or not modified_time:
+            return
+
+        if modified_time > watermark["time"]:
+            watermark["time"] = modified_time
+            watermark["ids"] = [alert.get("id")]
+        elif modified_time == watermark["time"] and alert.get("id") not in watermark["ids"]:
+            watermark["ids"].append(alert.get("id"))
+
+    def _checkpoint_watermark(self, ingest):
+        """This function is used to save the watermark of a scheduled poll or backfill to the state file right away.
+        :param ingest: Ingestion state created by _new_ingest
+        """
+        watermark = ingest["watermark"]
+        if not watermark:
+            return
+
+        watermark["state"][watermark["time_key"]] = watermark["time"]
+        watermark["state"][watermark["ids_key"]] = watermark["ids"]
+        self.save_state(self._state)
+
+    def _get_alert_priority(self, alert):
+        """This function is used to rank an alert by malware presence, severity, email status and number of recipients.
+        :param alert: Data of single alert
+        :return: tuple, higher is more important
+        """
+        attributes = alert.get("attributes") or {}
+        alert_data = attributes.get("alert") or {}
+        email = attributes.get("email") or {}
+
+        malware = bool((attributes.get("meta") or {}).get("last_malware") or alert_data.get("malware_md5"))
+        severity = FIREEYEETP_SEVERITY_LEVELS.get(str(alert_data.get("severity") or "").lower(), 0)
+
+        status = email.get("status")
+        statuses = status if isinstance(status, list) else [status]
+        status_rank = max((FIREEYEETP_PRIORITY_EMAIL_STATUS.get(str(x).lower(), 0) for x in statuses if x), default=0)
+
+        recipients = (email.get("smtp") or {}).get("rcpt_to") or []
+        if isinstance(recipients, str):
+            recipients = [x for x in recipients.split(",") if x.strip()]
+        recipient_count = len(recipients) if isinstance(recipients, list) else 0
+
+        # Newer alerts come first among alerts of the same rank
+        return malware, severity, status_rank, recipient_count, self._get_alert_modified_time(alert) or ""
+
+    def _prioritize_alerts(self, pages, deferred, limit, ingest, action_result):
+        """This function is used to stream pages of alerts through a bounded heap, keeping the most important alerts up to the limit.
+        The next most important alerts are deferred to the next poll, up to FIREEYEETP_MAX_DEFERRED_ALERTS, the others are dropped.
+        :param pages: Iterable of status and list of alerts
+        :param deferred: List of the alerts deferred by the previous poll
+        :param limit: Number of alerts to ingest
+        :param ingest: Ingestion state created by _new_ingest, updated with the deferred alerts and the number of dropped alerts
+        :param action_result: Action result object
+        :return: status success/failure, list of the alerts to ingest, most important first
+        """
+        counter = itertools.count()
+        top = []
+        backlog = []
+
+        def push(alert):
+            entry = (self._get_alert_priority(alert), next(counter), alert)
+            if len(top) < limit:
+                heapq.heappush(top, entry)
+                return
+            entry = heapq.heappushpop(top, entry)
+            if len(backlog) < FIREEYEETP_MAX_DEFERRED_ALERTS:
+                heapq.heappush(backlog, entry)
+            else:
+                heapq.heappushpop(backlog, entry)
+                ingest["dropped"] += 1
+
+        for alert in deferred:
+            push(alert)
+
+        for ret_val, alerts in pages:
+            if phantom.is_fail(ret_val):
+                return RetVal(action_result.get_status(), None)
+
+            for alert in alerts:
+                if self._is_below_watermark(ingest, alert):
+                    ingest["skipped"] += 1
+                    continue
+
+                if self._alert_matches_filters(alert, ingest["filters"]):
+                    push(alert)
+                else:
+                    ingest["filtered"] += 1
+
+                # Every alert received is either ingested, deferred or dropped now
+                self._advance_watermark(ingest, alert)
+
+        ingest["deferred"] = [entry[2] for entry in sorted(backlog, reverse=True)]
+        return RetVal(phantom.APP_SUCCESS, [entry[2] for entry in sorted(top, reverse=True)])
+
+    def _load_deferred_alerts(self, path):
+        """This function is used to load the alerts deferred by the previous poll.
+        :param path: Path of the file holding the deferred alerts
+        :return: list of alerts, an unreadable file gives an empty list
+        """
+        try:
+            with open(path) as f:
+                alerts = json.load(f)
+            return [alert for alert in alerts if isinstance(alert, dict)]
+        except Exception:
+            return []
+
+    def _save_deferred_alerts(self, path, alerts):
+        """This function is used to persist the alerts deferred to the next poll.
+        :param path: Path of the file holding the deferred alerts
+        :param alerts: List of alerts
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(alerts, f)
+        os.replace(tmp_path, path)
+
+    def _get_poll_filters(self, action_result, config):
+        """This function is used to get the alert filters of polling from the asset configuration.
+        :param action_result: Action result object
+        :param config: Asset configuration
+        :return: status success/failure, dict of the attributes sent to the API and of the filters applied to each alert
+        """
+        filters = {"attributes": {}}
+
+        for key, name in (("poll_email_status", "email_status"), ("poll_malware_names", "malware_names"), ("poll_domains", "domains")):
+            values = [x.strip() for x in str(config.get(key) or "").split(",")]
+            filters[name] = [_f for _f in values if _f]
+
+        # The alerts API filters on email status, sent as the comma-separated string list alerts sends,
+        # the other filters are applied to each alert
+        if filters["email_status"]:
+            filters["attributes"]["email_status"] = ",".join(filters["email_status"])
+        filters["malware_names"] = {x.lower() for x in filters["malware_names"]}
+        filters["domains"] = {x.lower().lstrip("@") for x in filters["domains"]}
+
+        min_severity = config.get("poll_min_severity") or FIREEYEETP_SEVERITY_ANY
+        if min_severity != FIREEYEETP_SEVERITY_ANY and min_severity not in FIREEYEETP_SEVERITY_LEVELS:
+            return RetVal(action_result.set_status(phantom.APP_ERROR, FIREEYEETP_MIN_SEVERITY_ERR), None)
+        filters["min_severity"] = FIREEYEETP_SEVERITY_LEVELS.get(min_severity, 0)
+
+        return RetVal(phantom.APP_SUCCESS, filters)
+
+    def _alert_matches_filters(self, alert, filters):
+        """This function is used to check an alert against the filters of polling the API could not apply.
+        :param alert: Data of single alert
+        :param filters: Filters created by _get_poll_filters, or None
+        :return: True if the alert is to be ingested
+        """
+        if not filters:
+            return True
+
+        attributes = alert.get("attributes") or {}
+        alert_data = attributes.get("alert") or {}
+        email = attributes.get("email") or {}
+
+        # Alerts without a known severity are kept
+        if filters["min_severity"]:
+            severity = FIREEYEETP_SEVERITY_LEVELS.get(str(alert_data.get("severity") or "").lower())
+            if severity is not None and severity < filters["min_severity"]:
+                return False
+
+        if filters["malware_names"]:
+            names = [(attributes.get("meta") or {}).get("last_malware")]
+            malware = (((alert_data.get("explanation") or {}).get("malware_detected") or {}).get("malware")) or []
+            if isinstance(malware, dict):
+                malware = [malware]
+            names.extend(x.get("name") for x in malware if isinstance(x, dict))
+            if not any(isinstance(x, str) and x.lower() in filters["malware_names"] for x in names):
+                return False
+
+        if filters["domains"]:
+            recipients = []
+            for value in ((email.get("smtp") or {}).get("rcpt_to"), (email.get("headers") or {}).get("to")):
+                if isinstance(value, str):
+                    value = value.split(",")
+                if isinstance(value, list):
+                    recipients.extend(x for x in value if isinstance(x, str))
+            domains = {x.rsplit("@", 1)[-1].strip(" <>\"'").lower() for x in recipients if "@" in x}
+            if not domains & filters["domains"]:
+                return False
+
+        return True
+
+    def _get_alert_group_key(self, ingest, alert):
+        """This function is used to get the key grouping the alerts of an ingestion run into one container.
+        :param ingest: Ingestion state created by _new_ingest
+        :param alert: Data of single alert
+        :return: group key or None when the alert is not grouped
+        """
+        email = (alert.get("attributes") or {}).get("email") or {}
+
+        if ingest["group_by"] == FIREEYEETP_GROUP_BY_MESSAGE:
+            message_id = email.get("etp_message_id")
+            return f"message:{message_id}" if message_id else None
+
+        if ingest["group_by"] == FIREEYEETP_GROUP_BY_SUBJECT_SENDER:
+            subject = (email.get("headers") or {}).get("subject")
+            sender = (email.get("smtp") or {}).get("mail_from") or (email.get("headers") or {}).get("from")
+            try:
+                modified_time = datetime.strptime(self._get_alert_modified_time(alert)[:19], "%Y-%m-%dT%H:%M:%S")
+            except Exception:
+                return None
+            if not subject or not sender:
+                return None
+
+            # Alerts are grouped within fixed windows of group_window minutes
+            window = int(modified_time.replace(tzinfo=timezone.utc).timestamp()) // (ingest["group_window"] * 60)
+            key = json.dumps([str(subject).strip().lower(), str(sender).strip().lower(), window])
+            return f"subject_sender:{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+
+        return None
+
+    def _queue_alert(self, ingest, alert, action_result):
+        """This function is used to queue the container of an alert, or the artifacts of an alert already ingested,
+        saving the queue once it reaches the batch size.
+        :param ingest: Ingestion state created by _new_ingest
+        :param alert: Data of single alert
+        :param action_result: Action result object
+        """
+        alert_id = alert.get("id")
+        seen_alerts = ingest["seen_alerts"]
+        container_id = seen_alerts.get(alert_id) if seen_alerts is not None and alert_id else None
+
+        try:
+            if container_id or alert_id in ingest["queued_ids"]:
+                if not container_id or ingest["modified_alerts"] == FIREEYEETP_MODIFIED_ALERTS_SKIP:
+                    ingest["skipped"] += 1
+                    return
+
+                # Add the modified alert to its existing container
+                artifacts = self._create_artifacts(alert=alert)
+                for artifact in artifacts:
+                    artifact["container_id"] = container_id
+                ingest["artifacts"].extend(artifacts)
+                ingest["updated"] += 1
+            else:
+                group_key = self._get_alert_group_key(ingest, alert)
+                groups = ingest["groups"]
+                group_container_id = groups.get(group_key) if groups is not None and group_key else None
+
+                if group_container_id:
+                    # Add the alert to the container of its group created by an earlier batch or poll
+                    artifacts = self._create_artifacts(alert=alert)
+                    for artifact in artifacts:
+                        artifact["container_id"] = group_container_id
+                    ingest["artifacts"].extend(artifacts)
+                    if seen_alerts is not None and alert_id:
+                        seen_alerts.add(alert_id, group_container_id)
+                    ingest["grouped"] += 1
+                elif group_key in ingest["pending_groups"]:
+                    # Add the alert to the queued container of its group
+                    position = ingest["pending_groups"][group_key]
+                    ingest["containers"][position]["artifacts"].extend(self._create_artifacts(alert=alert))
+                    ingest["alert_ids"][position].append(alert_id)
+                    ingest["grouped"] += 1
+                else:
+                    # Create a container for each alert or group of alerts
+                    container_dict = self._create_container(action_result, alert)
+                    container_dict["artifacts"] = self._create_artifacts(alert=alert)
+                    if group_key:
+                        ingest["pending_groups"][group_key] = len(ingest["containers"])
+                    ingest["containers"].append(container_dict)
+                    ingest["alert_ids"].append([alert_id])
+                    ingest["group_keys"].append(group_key)
+                ingest["queued_ids"].add(alert_id)
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            self.save_progress(f"Error while creating container for alert {alert_id}. {err}")
+            ingest["failed"] += 1
+            return
+
+        if len(ingest["containers"]) >= ingest["batch_size"] or len(ingest["artifacts"]) >= ingest["batch_size"]:
+            self._flush_ingest(ingest)
+
+    def _flush_ingest(self, ingest):
+        """This function is used to save the queued containers and artifacts and record the new containers in the seen alert index.
+        :param ingest: Ingestion state created by _new_ingest
+        """
+        seen_alerts = ingest["seen_alerts"]
+
+        if ingest["containers"]:
+            container_ids = self._save_containers_batch(ingest["containers"])
+            for alert_ids, group_key, container_id in zip(ingest["alert_ids"], ingest["group_keys"], container_ids):
+                if not container_id:
+                    ingest["failed"] += 1
+                    continue
+                ingest["saved"] += 1
+                if seen_alerts is not None:
+                    for alert_id in alert_ids:
+                        if alert_id:
+                            seen_alerts.add(alert_id, container_id)
+                if ingest["groups"] is not None and group_key:
+                    ingest["groups"].add(group_key, container_id)
+            ingest["containers"] = []
+            ingest["alert_ids"] = []
+            ingest["group_keys"] = []
+            ingest["pending_groups"] = {}
+
+        if ingest["artifacts"]:
+            ret_val, message, _ = self.save_artifacts(ingest["artifacts"])
+            if phantom.is_fail(ret_val):
+                self.save_progress(f"Error while adding the artifacts of modified alerts to their containers. {message}")
+            ingest["artifacts"] = []
+
+        ingest["queued_ids"] = set()
+
+        if seen_alerts is not None:
+            try:
+                seen_alerts.save()
+            except Exception as e:
+                err = self._get_error_message_from_exception(e)
+                self.debug_print(f"Unable to save the seen alert index. {err}")
+
+        if ingest["groups"] is not None:
+            try:
+                ingest["groups"].save()
+            except Exception as e:
+                err = self._get_error_message_from_exception(e)
+                self.debug_print(f"Unable to save the alert group index. {err}")
+
+    def _save_containers_batch(self, containers):
+        """This function is used to save a batch of containers with a single platform call.
+        If the batch fails, the containers are saved one by one so that a bad alert only loses its own container.
+        :param containers: list of container dictionaries with their artifacts
+        :return: list of container IDs, None for the containers that could not be saved
+        """
+        ret_val, message, responses = self.save_containers(containers)
+
+        if phantom.is_success(ret_val) and isinstance(responses, list) and len(responses) == len(containers):
+            container_ids = []
+            for container_dict, response in zip(containers, responses):
+                container_id = None
+                if isinstance(response, dict) and response.get("success"):
+                    container_id = response.get("id") or response.get("existing_container_id")
+                if not container_id:
+                    self.save_progress(f"Error while creating container for alert {container_dict['name']}. {response}")
+                container_ids.append(container_id)
+            return container_ids
+
+        self.debug_print(f"Error while saving a batch of {len(containers)} containers, saving them one by one. {message}")
+
+        container_ids = []
+        for container_dict in containers:
+            container_creation_status, container_creation_msg, container_id = self.save_container(container=container_dict)
+
+            if phantom.is_fail(container_creation_status):
+                self.debug_print(container_creation_msg)
+                self.save_progress(
+                    "Error while creating container for alert {alert_name}. {error_message}".format(
+                        alert_name=container_dict["name"], error_message=container_creation_msg
+                    )
+                )
+                container_id = None
+
+            container_ids.append(container_id)
+
+        return container_ids
+
     def _convert_timestamp_to_string(self, timestamp, tz):
         """This function is used to handle of timestamp converstion for on_poll action.
         :param timestamp: Epoch time stamp
@@ -1225,62 +3145,110 @@ class FireeyeEtpConnector(BaseConnector):
         name = "Fireeye ETP Alert - {}".format(alert.get("attributes", {}).get("meta", {}).get("last_malware"))
 
         container_dict["name"] = f"{name}"
-        container_dict["source_data_identifier"] = self._create_dict_hash(alert)
+        container_dict["source_data_identifier"] = self._get_alert_fingerprint(alert) or self._create_dict_hash(alert)
         container_dict["description"] = description
 
         return container_dict
 
     def _create_artifacts(self, alert):
-        """This function is used to create artifacts in given container using alert data.
+        """This function is used to create one artifact per indicator of an alert, and one artifact with the details of the alert.
+        The indicators are declared in FIREEYEETP_ARTIFACT_INDICATORS.
         :param alert: Data of single alert
-        :param container_id: ID of container in which we have to create the artifacts
-        :return: status(success/failure), message
+        :return: list of artifacts
         """
         artifacts_list = []
-        temp_dict = {}
-        cef = {}
-
-        # Add the contains data to the artifact
-        cef_types = {
-            "malware_md5": ["fileHashMd5"],
-            "source_ip": ["sourceAddress"],
-            "etp_message_id": ["fireeyeetp message id"],
-            "legacy_id": ["fireeyeetp legacy id"],
-            "id": ["fireeyeetp alert id"],
-            "rcpt_to": ["email"],
-            "mail_from": ["email"],
-            "to": ["email"],
-            "cc": ["email"],
-            "from": ["email"],
-        }
-
-        # Flatten the alert data
-        cef = self.flatten_json(alert)
+        alert_id = alert.get("id")
 
-        # Add into artifacts dictionary if it is available
+        # Details of the alert, referenced by the indicator artifacts through the alert ID
+        cef = {}
+        for key, path in FIREEYEETP_ALERT_DETAIL_FIELDS.items():
+            values = self._get_path_values(alert, path)
+            if values:
+                cef[key] = values[0]
+        if self._alert_detail_fields:
+            cef.update(self.flatten_json(alert, allowlist=self._alert_detail_fields))
         if cef:
-            temp_dict["cef"] = cef
-            temp_dict["cef_types"] = cef_types
-            temp_dict["name"] = alert.get("attributes", {}).get("meta", {}).get("last_malware")
-            temp_dict["source_data_identifier"] = self._create_dict_hash(temp_dict)
+            temp_dict = {
+                "name": "Alert Details",
+                "cef": cef,
+                "cef_types": {key: value for key, value in FIREEYEETP_ALERT_DETAIL_CEF_TYPES.items() if key in cef},
+            }
+            temp_dict["source_data_identifier"] = self._get_alert_fingerprint(alert, "details") or self._create_dict_hash(temp_dict)
+            artifacts_list.append(temp_dict)
+
+        seen = set()
+        for indicator in FIREEYEETP_ARTIFACT_INDICATORS:
+            for path in indicator["paths"]:
+                values = self._get_path_values(alert, path)
+                if indicator["email"]:
+                    values = [address for _, address in getaddresses([x for x in values if isinstance(x, str)])]
+
+                for value in values:
+                    if value in (None, "", []):
+                        continue
+                    # The same indicator is often found in several places of the alert
+                    key = (indicator["cef_key"], str(value).lower() if indicator["email"] else value)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+
+                    temp_dict = {
+                        "name": indicator["name"],
+                        "cef": {indicator["cef_key"]: value},
+                        "cef_types": {indicator["cef_key"]: indicator["cef_types"]},
+                    }
+                    if indicator["legacy_key"]:
+                        temp_dict["cef"][indicator["legacy_key"]] = value
+                        temp_dict["cef_types"][indicator["legacy_key"]] = indicator["cef_types"]
+                    if alert_id:
+                        temp_dict["cef"]["id"] = alert_id
+                        temp_dict["cef_types"]["id"] = ["fireeyeetp alert id"]
+                    # Unlike the alert details, an indicator does not change with the alert, so a modified alert
+                    # updating its container does not add the same indicator again
+                    if alert_id:
+                        temp_dict["source_data_identifier"] = fingerprint(alert_id, indicator["cef_key"], value)
+                    else:
+                        temp_dict["source_data_identifier"] = self._create_dict_hash(temp_dict)
+                    artifacts_list.append(temp_dict)
 
-        artifacts_list.append(temp_dict)
         return artifacts_list
 
-    def _get_fips_enabled(self):
-        try:
-            from phantom_common.install_info import is_fips_enabled
-        except ImportError:
-            return False
-
-        fips_enabled = is_fips_enabled()
-
-        if fips_enabled:
-            self.debug_print("FIPS is enabled")
-        else:
-            self.debug_print("FIPS is not enabled")
+    def _get_path_values(self, data, path):
+        """This function is used to get the values at a path of keys in a JSON dictionary, '*' stands for each item of a list.
+        :param data: JSON dictionary
+        :param path: List of keys
+        :return: list of the values found, lists of values are expanded
+        """
+        current = [data]
+        for key in path:
+            found = []
+            for item in current:
+                if key == "*":
+                    if isinstance(item, list):
+                        found.extend(item)
+                elif isinstance(item, dict) and item.get(key) is not None:
+                    found.append(item[key])
+            current = found
+
+        values = []
+        for item in current:
+            if isinstance(item, list):
+                values.extend(x for x in item if not isinstance(x, (dict, list)))
+            elif not isinstance(item, dict):
+                values.append(item)
+        return values
+
+    def _get_alert_fingerprint(self, alert, *parts):
+        """This function is used to generate an identifier from the ID and last modification time of an alert.
+        :param alert: Data of single alert
+        :param parts: Values telling apart the artifacts of the alert
+        :return: identifier, or None when the alert has no ID
+        """
+        alert_id = alert.get("id")
+        if not alert_id:
+            return None
 
-        return fips_enabled
+        return fingerprint(alert_id, self._get_alert_modified_time(alert), *parts)
 
     def _create_dict_hash(self, input_dict):
         """This function is used to generate the hash from dictionary.
@@ -1297,32 +3265,64 @@ class FireeyeEtpConnector(BaseConnector):
             self.debug_print("Handled exception in _create_dict_hash", err)
             return None
 
-        if self._get_fips_enabled():
-            return hashlib.sha256(input_dict_str).hexdigest()
-        else:
-            return hashlib.md5(input_dict_str).hexdigest()
+        return fingerprint(input_dict_str)
 
-    def flatten_json(self, y):
+    def flatten_json(self, y, allowlist=None, max_depth=FIREEYEETP_FLATTEN_MAX_DEPTH, max_keys=FIREEYEETP_FLATTEN_MAX_KEYS):
         """This function is used to generate a new JSON dictionary so the data flattened to the top most values.
-        Helps with readability of the artifacts in the GUI.
+        Helps with readability of the artifacts in the GUI. The keys are the paths of the values, e.g. 'email.headers.to[0]'.
         :param y: JSON Dictionary of the data to flatten
+        :param allowlist: Optional list of paths, without list indexes, of the fields to keep along with everything below them
+        :param max_depth: Values nested deeper than this are kept as a JSON string
+        :param max_keys: Maximum number of keys in the new dictionary
         :return out: new JSON dictionary
         """
         out = {}
 
-        def flatten(x, name=""):
-            if type(x) is dict:
-                for a in x:
-                    flatten(x[a], a)
-            elif type(x) is list:
-                i = 0
-                for a in x:
-                    flatten(a, name)
-                    i += 1
-            else:
-                out[name] = x
+        # Every parent path of an allowed path has to be walked to reach it
+        allowed = set(allowlist or [])
+        parents = set()
+        for path in allowed:
+            parts = path.split(".")
+            parents.update(".".join(parts[:i]) for i in range(1, len(parts)))
+
+        # Each entry is the key, the value, the depth and the path without list indexes,
+        # which is None once the value is allowed so that everything below it is kept without further checks
+        stack = [("", y, 0, "" if allowed else None)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            key, x, depth, field = pop()
+            x_type = type(x)
+
+            if x_type is dict or x_type is list:
+                if depth >= max_depth:
+                    if field is None:
+                        if len(out) >= max_keys:
+                            break
+                        out[key] = json.dumps(x)
+                    continue
+                depth += 1
+                # The stack is last in first out, push the items in reverse to keep their order
+                if x_type is list:
+                    for i in range(len(x) - 1, -1, -1):
+                        push((f"{key}[{i}]", x[i], depth, field))
+                elif field is None:
+                    prefix = f"{key}." if key else ""
+                    for a in reversed(x):
+                        push((prefix + a, x[a], depth, None))
+                else:
+                    prefix = f"{key}." if key else ""
+                    for a in reversed(x):
+                        child_field = f"{field}.{a}" if field else a
+                        if child_field in allowed:
+                            push((prefix + a, x[a], depth, None))
+                        elif child_field in parents:
+                            push((prefix + a, x[a], depth, child_field))
+            elif field is None:
+                if len(out) >= max_keys:
+                    break
+                out[key] = x
 
-        flatten(y)
         return out
 
     def handle_action(self, param):
@@ -1335,6 +3335,8 @@ class FireeyeEtpConnector(BaseConnector):
             "test_connectivity": self._handle_test_connectivity,
             "list_alerts": self._handle_list_alerts,
             "get_alert": self._handle_get_alert,
+            "get_alerts": self._handle_get_alerts,
+            "download_alert_files": self._handle_download_alert_files,
             "list_email_attributes": self._handle_list_email_attributes,
             "get_email_attributes": self._handle_get_email_attributes,
             "trace_message": self._handle_trace_message,
@@ -1395,29 +3397,187 @@ class FireeyeEtpConnector(BaseConnector):
 
         self._verify_server_cert = config.get("verify_server_cert", True)
 
+        ret_val = self._create_session(config)
+        if phantom.is_fail(ret_val):
+            return self.get_status()
+
+        ret_val = self._configure_rate_limit(config)
+        if phantom.is_fail(ret_val):
+            return self.get_status()
+
         api_key = config.get("api_key", "")
         if isinstance(api_key, str) and api_key.strip():
             self._header = {"x-fireeye-api-key": api_key.strip()}
         else:
-            self._header = self.authenticate(config)
+            self._use_oauth = True
+            # Test connectivity checks the credentials, not a token cached from an earlier run
+            self._header = self.authenticate(config, force_refresh=self.get_action_identifier() == "test_connectivity")
 
         # Check to see which instance the user selected. Use the appropriate URL.
         base_url = config.get("base_url").rstrip("/")
 
         self._base_url = f"{base_url}/{FIREETEETP_API_PATH}"
 
+        # The maximum download size is configured in MB
+        ret_val, max_download_size = self._validate_integer(self, config.get("max_download_size", 0), MAX_DOWNLOAD_SIZE_KEY, True)
+        if phantom.is_fail(ret_val):
+            return self.get_status()
+        self._max_download_size = max_download_size * 1024 * 1024
+
+        ret_val, self._debug_body_limit = self._validate_integer(
+            self, config.get("debug_body_limit", FIREEYEETP_DEFAULT_DEBUG_BODY_LIMIT), DEBUG_BODY_LIMIT_KEY, True
+        )
+        if phantom.is_fail(ret_val):
+            return self.get_status()
+
+        # Paths of the alert fields added to the alert details artifacts
+        detail_fields = [x.strip() for x in str(config.get("alert_detail_fields") or "").split(",")]
+        self._alert_detail_fields = [_f for _f in detail_fields if _f]
+
+        return phantom.APP_SUCCESS
+
+    def _create_session(self, config):
+        """Create the HTTP session shared by every API call of this run.
+        The session keeps connections alive so paginated and repeated calls reuse the same TCP/TLS connection.
+        :param config: Asset configuration
+        :return: status success/failure
+        """
+        ret_val, pool_connections = self._validate_integer(
+            self, config.get("pool_connections", FIREEYEETP_DEFAULT_POOL_CONNECTIONS), POOL_CONNECTIONS_KEY
+        )
+        if phantom.is_fail(ret_val):
+            return ret_val
+
+        ret_val, pool_maxsize = self._validate_integer(self, config.get("pool_maxsize", FIREEYEETP_DEFAULT_POOL_MAXSIZE), POOL_MAXSIZE_KEY)
+        if phantom.is_fail(ret_val):
+            return ret_val
+
+        self._pool_maxsize = pool_maxsize
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        if not config.get("keep_alive", True):
+            self._session.headers["Connection"] = "close"
+
+        return phantom.APP_SUCCESS
+
+    def _get_cached_token(self, config):
+        """Get the OAuth token cached in the state file if it was issued for the configured credentials and is not about to expire.
+        :param config: Asset configuration
+        :return: header with bearer token or None
+        """
+        token = self._state.get(FIREEYEETP_OAUTH_TOKEN_STATE_KEY)
+        if not isinstance(token, dict):
+            return None
+
+        # A token issued before the client ID, secret or scopes changed is not reused
+        if token.get("credentials") != self._get_credentials_digest(config):
+            return None
+
+        try:
+            if float(token.get("expires_at", 0)) - FIREEYEETP_TOKEN_REFRESH_MARGIN <= time.time():
+                return None
+            access_token = encryption_helper.decrypt(token["access_token"], self.get_asset_id())
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            self.debug_print(f"Unable to use the cached OAuth token. {err}")
+            self._state.pop(FIREEYEETP_OAUTH_TOKEN_STATE_KEY, None)
+            return None
+
+        return {"Authorization": f"{token.get('token_type')} {access_token}"}
+
+    def _get_credentials_digest(self, config):
+        """Get a digest of the OAuth credentials, so that a cached token can be tied to them without storing the secret.
+        :param config: Asset configuration
+        :return: digest of the client ID, secret and scopes
+        """
+        return fingerprint(config.get("client_id"), config.get("client_secret"), config.get("auth_scopes"))
+
+    def _cache_token(self, config, response_data):
+        """Store the OAuth token encrypted in the state file along with its expiry time.
+        :param config: Asset configuration
+        :param response_data: Response of the token endpoint
+        """
+        try:
+            expires_in = int(response_data.get("expires_in") or 0)
+        except Exception:
+            expires_in = 0
+
+        if expires_in <= 0:
+            self._state.pop(FIREEYEETP_OAUTH_TOKEN_STATE_KEY, None)
+            return
+
+        try:
+            access_token = encryption_helper.encrypt(response_data["access_token"], self.get_asset_id())
+        except Exception as e:
+            err = self._get_error_message_from_exception(e)
+            self.debug_print(f"Unable to encrypt the OAuth token, it will not be cached. {err}")
+            self._state.pop(FIREEYEETP_OAUTH_TOKEN_STATE_KEY, None)
+            return
+
+        self._state[FIREEYEETP_OAUTH_TOKEN_STATE_KEY] = {
+            "credentials": self._get_credentials_digest(config),
+            "token_type": response_data["token_type"],
+            "access_token": access_token,
+            "expires_at": time.time() + expires_in,
+        }
+
+    def _configure_rate_limit(self, config):
+        """Set up the client-side rate limiter and the retry policy from the asset configuration.
+        :param config: Asset configuration
+        :return: status success/failure
+        """
+        ret_val, rate_limit = self._validate_integer(self, config.get("rate_limit", 0), RATE_LIMIT_KEY, True)
+        if phantom.is_fail(ret_val):
+            return ret_val
+
+        ret_val, rate_limit_burst = self._validate_integer(
+            self, config.get("rate_limit_burst", FIREEYEETP_DEFAULT_RATE_LIMIT_BURST), RATE_LIMIT_BURST_KEY
+        )
+        if phantom.is_fail(ret_val):
+            return ret_val
+
+        ret_val, self._max_retries = self._validate_integer(
+            self, config.get("max_retries", FIREEYEETP_DEFAULT_MAX_RETRIES), MAX_RETRIES_KEY, True
+        )
+        if phantom.is_fail(ret_val):
+            return ret_val
+
+        ret_val, self._max_retry_time = self._validate_integer(
+            self, config.get("max_retry_time", FIREEYEETP_DEFAULT_MAX_RETRY_TIME), MAX_RETRY_TIME_KEY, True
+        )
+        if phantom.is_fail(ret_val):
+            return ret_val
+
+        # The rate limit is configured in requests per minute and shared by all the runs of the asset
+        if rate_limit:
+            path = os.path.join(self.get_state_dir(), f"{self.get_asset_id()}_rate_limit.json")
+            self._rate_limiter = SharedTokenBucket(path, rate_limit / 60.0, rate_limit_burst)
+
         return phantom.APP_SUCCESS
 
-    def authenticate(self, config):
-        """Authenticate using client id and secret, return the header with bearer token"""
+    def authenticate(self, config, force_refresh=False):
+        """Authenticate using client id and secret, return the header with bearer token.
+        The token is cached in the state file and reused until shortly before it expires.
+        :param config: Asset configuration
+        :param force_refresh: Ignore the cached token and request a new one
+        :return: header with bearer token
+        """
         if not config.get("client_id") or not config.get("client_secret") or not config.get("auth_scopes"):
             raise ValueError("One or more of client_id, client_secret or auth_scopes was left unset. Unable to get authentication token.")
 
+        if not force_refresh:
+            header = self._get_cached_token(config)
+            if header:
+                return header
+
         auth_scopes_split_re = re.compile(r"[\s,]+")
         auth_scopes_str = " ".join(auth_scopes_split_re.split(config.get("auth_scopes", "").strip()))
         auth_headers = {"Content-Type": "application/x-www-form-urlencoded"}
         auth_data = {"grant_type": "client_credentials", "scope": auth_scopes_str}
-        response = requests.post(
+        response = self._session.post(
             FIREEYEETP_AUTH_URL,
             headers=auth_headers,
             auth=(config.get("client_id"), config.get("client_secret")),
@@ -1428,11 +3588,19 @@ class FireeyeEtpConnector(BaseConnector):
         response_data = response.json()
         if response.status_code != 200:
             raise ValueError(f"Authentication error: status_code={response.status_code}, data={response_data}")
+
+        self._cache_token(config, response_data)
+
         return {"Authorization": f"{response_data['token_type']} {response_data['access_token']}"}
 
     def finalize(self):
         # Save the state, this data is saved across actions and app upgrades
         self.save_state(self._state)
+
+        # Release the pooled connections
+        if self._session:
+            self._session.close()
+
         return phantom.APP_SUCCESS
 
 
@@ -31,6 +31,20 @@ FIREEYEETP_RELEASE_QUARANTINED_EMAIL_ENDPOINT = "quarantine/release/{etp_message
 FIREEYEETP_BULK_DELETE_QUARANTINE_EMAILS_ENDPOINT = "quarantine/delete/"
 FIREEYEETP_DELETE_QUARANTINED_EMAIL_ENDPOINT = "quarantine/delete/{etp_message_id}"
 FIREEYEETP_LIST_QUARANTINED_EMAILS_ENDPOINT = "quarantine"
+# Pagination cursor strategies: the request field holding the cursor, the response meta field holding the
+# cursor of the next page and the item field used to drop duplicates across page boundaries
+FIREEYEETP_PAGINATION_CURSORS = {
+    FIREETEETP_LIST_ALERTS_ENDPOINT: {
+        "request_path": ["fromLastModifiedOn"],
+        "meta_path": ["fromLastModifiedOn", "end"],
+        "id_field": "id",
+    },
+    FIREEYEETP_LIST_QUARANTINED_EMAILS_ENDPOINT: {
+        "request_path": ["attributes", "date", "to_date"],
+        "meta_path": ["timestamp_quarantine"],
+        "id_field": "message_id",
+    },
+}
 FIREEYEETP_AUTH_URL = "https://auth.trellix.com/auth/realms/IAM/protocol/openid-connect/token"
 
 # Constants relating to '_get_error_message_from_exception'
@@ -45,6 +59,8 @@ SIZE_KEY = "'size' action parameter"
 LEGACY_ID_KEY = "'legacy_id' action parameter"
 NUM_DAYS_KEY = "'num_days' action parameter"
 CONTAINER_COUNT_KEY = "'container_count' action parameter"
+SHARDS_KEY = "'shards' action parameter"
+MAX_WORKERS_KEY = "'max_workers' action parameter"
 
 # Constant for corrupt asset file
 FIREEYEETP_STATE_FILE_CORRUPT_ERR = "Error occurred while loading the state file due to its unexpected format.\
@@ -52,3 +68,242 @@ FIREEYEETP_STATE_FILE_CORRUPT_ERR = "Error occurred while loading the state file
 
 # Timeout
 FIREETEETP_DEFAULT_TIMEOUT = 30
+
+# Connection pool
+FIREEYEETP_DEFAULT_POOL_CONNECTIONS = 4
+FIREEYEETP_DEFAULT_POOL_MAXSIZE = 10
+POOL_CONNECTIONS_KEY = "'pool_connections' asset configuration parameter"
+POOL_MAXSIZE_KEY = "'pool_maxsize' asset configuration parameter"
+
+# OAuth token cache
+FIREEYEETP_OAUTH_TOKEN_STATE_KEY = "oauth_token"
+# Refresh the cached token this many seconds before it expires
+FIREEYEETP_TOKEN_REFRESH_MARGIN = 60
+
+# Rate limiting and retries
+FIREEYEETP_RETRY_STATUS_CODES = (429,)
+# Server errors are only retried for requests that are safe to send again
+FIREEYEETP_SERVER_ERROR_STATUS_CODES = (500, 502, 503, 504)
+FIREEYEETP_DEFAULT_MAX_RETRIES = 5
+# Maximum number of seconds spent waiting for retries during one run
+FIREEYEETP_DEFAULT_MAX_RETRY_TIME = 120
+FIREEYEETP_BACKOFF_FACTOR = 1
+FIREEYEETP_MAX_BACKOFF = 30
+FIREEYEETP_DEFAULT_RATE_LIMIT_BURST = 10
+# Seconds after which a rate limit waiter that stopped refreshing its queue entry is dropped
+FIREEYEETP_RATE_LIMIT_QUEUE_TTL = 30
+FIREEYEETP_RATE_LIMIT_MIN_WAIT = 0.05
+FIREEYEETP_RATE_LIMIT_MAX_WAIT = 1
+RATE_LIMIT_KEY = "'rate_limit' asset configuration parameter"
+RATE_LIMIT_BURST_KEY = "'rate_limit_burst' asset configuration parameter"
+MAX_RETRIES_KEY = "'max_retries' asset configuration parameter"
+MAX_RETRY_TIME_KEY = "'max_retry_time' asset configuration parameter"
+
+# File downloads
+FIREEYEETP_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_DOWNLOAD_SIZE_KEY = "'max_download_size' asset configuration parameter"
+
+# Debug data
+# Maximum number of bytes of a failed response body kept in the debug data
+FIREEYEETP_DEFAULT_DEBUG_BODY_LIMIT = 10240
+FIREEYEETP_TEXT_CONTENT_TYPES = ("json", "html", "text", "xml")
+DEBUG_BODY_LIMIT_KEY = "'debug_body_limit' asset configuration parameter"
+
+# Sharded list alerts
+FIREEYEETP_DEFAULT_NUM_DAYS = 90
+FIREEYEETP_SHARD_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000"
+# Number of rounds of splitting the time windows holding too many alerts
+FIREEYEETP_SHARD_SPLIT_ROUNDS = 2
+# Time windows shorter than this number of seconds are not split further
+FIREEYEETP_SHARD_MIN_SECONDS = 60
+# The number of time windows is capped at this multiple of the connection pool size
+FIREEYEETP_SHARD_POOL_MULTIPLIER = 4
+
+# Container ingestion
+FIREEYEETP_DEFAULT_CONTAINER_BATCH_SIZE = 100
+CONTAINER_BATCH_SIZE_KEY = "'container_batch_size' asset configuration parameter"
+
+# Seen alert index
+FIREEYEETP_DEFAULT_SEEN_ALERT_INDEX_SIZE = 10000
+SEEN_ALERT_INDEX_SIZE_KEY = "'seen_alert_index_size' asset configuration parameter"
+FIREEYEETP_MODIFIED_ALERTS_UPDATE = "update"
+FIREEYEETP_MODIFIED_ALERTS_SKIP = "skip"
+FIREEYEETP_MODIFIED_ALERTS_VALUES = [FIREEYEETP_MODIFIED_ALERTS_UPDATE, FIREEYEETP_MODIFIED_ALERTS_SKIP]
+FIREEYEETP_MODIFIED_ALERTS_ERR = (
+    "Please provide a valid value in the 'modified_alerts' asset configuration parameter. Valid values are: update, skip"
+)
+
+# Historical backfill
+FIREEYEETP_DEFAULT_BACKFILL_MAX_CONTAINERS = 1000
+FIREEYEETP_DEFAULT_BACKFILL_MAX_SECONDS = 300
+BACKFILL_DAYS_KEY = "'backfill_days' asset configuration parameter"
+BACKFILL_MAX_CONTAINERS_KEY = "'backfill_max_containers' asset configuration parameter"
+BACKFILL_MAX_SECONDS_KEY = "'backfill_max_seconds' asset configuration parameter"
+
+# Pipelined polling
+FIREEYEETP_DEFAULT_PREFETCH_PAGES = 2
+# Seconds between checks for a stopped consumer while the prefetch queue is full
+FIREEYEETP_PREFETCH_WAIT = 0.5
+PREFETCH_PAGES_KEY = "'prefetch_pages' asset configuration parameter"
+
+# Poll time budget
+# Share of the ingestion interval a scheduled poll may use when no time budget is configured
+FIREEYEETP_POLL_BUDGET_RATIO = 0.8
+FIREEYEETP_MIN_POLL_BUDGET = 60
+POLL_TIME_BUDGET_KEY = "'poll_time_budget' asset configuration parameter"
+
+# Poll filters
+FIREEYEETP_SEVERITY_ANY = "any"
+FIREEYEETP_SEVERITY_LEVELS = {"minr": 1, "minor": 1, "majr": 2, "major": 2, "crit": 3, "critical": 3}
+FIREEYEETP_MIN_SEVERITY_ERR = (
+    "Please provide a valid value in the 'poll_min_severity' asset configuration parameter. Valid values are: any, minor, major, critical"
+)
+
+# Prioritized polling
+# Rank of the email statuses, delivered emails reached the mailboxes
+FIREEYEETP_PRIORITY_EMAIL_STATUS = {
+    "delivered": 3,
+    "delivered (retroactive)": 3,
+    "released": 3,
+    "ace: passthrough": 2,
+    "quarantined": 1,
+}
+FIREEYEETP_MAX_DEFERRED_ALERTS = 1000
+
+# Alert grouping
+FIREEYEETP_GROUP_BY_NONE = "none"
+FIREEYEETP_GROUP_BY_MESSAGE = "message"
+FIREEYEETP_GROUP_BY_SUBJECT_SENDER = "subject_sender"
+FIREEYEETP_GROUP_BY_VALUES = [FIREEYEETP_GROUP_BY_NONE, FIREEYEETP_GROUP_BY_MESSAGE, FIREEYEETP_GROUP_BY_SUBJECT_SENDER]
+FIREEYEETP_GROUP_BY_ERR = (
+    "Please provide a valid value in the 'group_alerts_by' asset configuration parameter. Valid values are: none, message, subject_sender"
+)
+FIREEYEETP_DEFAULT_GROUP_WINDOW_MINS = 60
+GROUP_WINDOW_MINS_KEY = "'group_window_mins' asset configuration parameter"
+
+# Artifacts
+# Indicators extracted from an alert, one artifact per value. The values of 'email' indicators are email address lists
+# The legacy key holds the value under the CEF field name of the artifacts of earlier versions, kept for the existing playbooks
+FIREEYEETP_ARTIFACT_INDICATORS = [
+    {
+        "name": "Sender",
+        "cef_key": "mail_from",
+        "cef_types": ["email"],
+        "paths": [["attributes", "email", "smtp", "mail_from"], ["attributes", "email", "headers", "from"]],
+        "email": True,
+        "legacy_key": None,
+    },
+    {
+        "name": "Recipient",
+        "cef_key": "rcpt_to",
+        "cef_types": ["email"],
+        "paths": [
+            ["attributes", "email", "smtp", "rcpt_to"],
+            ["attributes", "email", "headers", "to"],
+            ["attributes", "email", "headers", "cc"],
+        ],
+        "email": True,
+        "legacy_key": None,
+    },
+    {
+        "name": "Malware MD5",
+        "cef_key": "fileHashMd5",
+        "cef_types": ["md5", "hash"],
+        "paths": [
+            ["attributes", "alert", "malware_md5"],
+            ["attributes", "alert", "explanation", "malware_detected", "malware", "*", "md5sum"],
+        ],
+        "email": False,
+        "legacy_key": "malware_md5",
+    },
+    {
+        "name": "Source IP",
+        "cef_key": "sourceAddress",
+        "cef_types": ["ip"],
+        "paths": [["attributes", "email", "source_ip"]],
+        "email": False,
+        "legacy_key": "source_ip",
+    },
+    {
+        "name": "Message ID",
+        "cef_key": "etp_message_id",
+        "cef_types": ["fireeyeetp message id"],
+        "paths": [["attributes", "email", "etp_message_id"]],
+        "email": False,
+        "legacy_key": None,
+    },
+]
+# Fields of the alert details artifact, named as in the artifacts of earlier versions
+FIREEYEETP_ALERT_DETAIL_FIELDS = {
+    "id": ["id"],
+    "legacy_id": ["attributes", "meta", "legacy_id"],
+    "subject": ["attributes", "email", "headers", "subject"],
+    "status": ["attributes", "email", "status"],
+    "last_malware": ["attributes", "meta", "last_malware"],
+    "timestamp": ["attributes", "alert", "timestamp"],
+    "last_modified_on": ["attributes", "meta", "last_modified_on"],
+}
+FIREEYEETP_ALERT_DETAIL_CEF_TYPES = {"id": ["fireeyeetp alert id"], "legacy_id": ["fireeyeetp legacy id"]}
+
+# Flattened alert fields
+FIREEYEETP_FLATTEN_MAX_DEPTH = 10
+FIREEYEETP_FLATTEN_MAX_KEYS = 500
+
+# Batch lookups
+FIREEYEETP_DEFAULT_MAX_WORKERS = 10
+
+# Alert files, endpoint and vault file name of each type
+FIREEYEETP_ALERT_FILE_TYPES = {
+    "pcap": (FIREETEETP_GET_ALERT_PCAP_FILES_ENDPOINT, "{alertId}_pcap.zip"),
+    "malware": (FIREETEETP_GET_ALERT_MALWARE_FILES_ENDPOINT, "{alertId}_malware.zip"),
+    "case": (FIREETEETP_GET_ALERT_CASE_FILES_ENDPOINT, "{alertId}_case.zip"),
+}
+FIREEYEETP_FILE_TYPES_ERR = "Please provide a valid value in 'file_types' action parameter. Valid values are: pcap, malware, case"
+
+# Archive files
+FIREEYEETP_ZIP_FILE_TYPES = ["malware", "case"]
+# Files of these types are added to the vault, the others are only hashed
+FIREEYEETP_ZIP_MEMBER_EXTENSIONS = {
+    ".exe",
+    ".dll",
+    ".scr",
+    ".com",
+    ".bat",
+    ".cmd",
+    ".ps1",
+    ".vbs",
+    ".js",
+    ".jar",
+    ".hta",
+    ".lnk",
+    ".doc",
+    ".docx",
+    ".docm",
+    ".xls",
+    ".xlsx",
+    ".xlsm",
+    ".ppt",
+    ".pptx",
+    ".pptm",
+    ".rtf",
+    ".pdf",
+    ".one",
+    ".eml",
+    ".msg",
+}
+# Executables, PDF, OLE2 documents and RTF documents
+FIREEYEETP_ZIP_MEMBER_MAGIC = (b"MZ", b"%PDF", b"\xd0\xcf\x11\xe0", b"{\\rtf")
+# Zip bomb limits
+FIREEYEETP_ZIP_MAX_MEMBERS = 1000
+FIREEYEETP_ZIP_MAX_MEMBER_SIZE = 100 * 1024 * 1024
+FIREEYEETP_ZIP_MAX_TOTAL_SIZE = 1024 * 1024 * 1024
+FIREEYEETP_ZIP_MAX_RATIO = 100
+
+# Email parsing
+FIREEYEETP_EMAIL_MAX_PARSE_SIZE = 50 * 1024 * 1024
+FIREEYEETP_EMAIL_MAX_PARTS = 200
+# Bytes of each text part searched for URLs
+FIREEYEETP_EMAIL_MAX_TEXT_SIZE = 1024 * 1024
+FIREEYEETP_EMAIL_MAX_URLS = 100
+FIREEYEETP_URL_REGEX = r"https?://[^\s<>\"'()\[\]]+"
+FIREEYEETP_IP_REGEX = r"\b(?:\d{1,3}\.){3}\d{1,3}\b"